@@ -0,0 +1,63 @@
+#bench_contrast.py
+#
+#Times imtools.scale_alpha_beta against the original per-pixel loop on a full
+#  3660x3660 HLS tile (3 bands), and on a small (time,y,x,band) time series.
+#  The loop takes minutes on a full tile, so by default it runs on a strip of
+#  --rows rows and its time is scaled up to the full tile. Use --full to run it
+#  on the whole tile instead.
+#
+#Usage: python benchmarks/bench_contrast.py [--rows 64] [--full] [--times 4]
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from imtools import scale_alpha_beta
+
+#The original implementation, kept here as the baseline.
+def scale_alpha_beta_loop(im,alpha,beta):
+    for y in range(im.shape[0]):
+        for x in range(im.shape[1]):
+            for c in range(im.shape[2]):
+                im[y,x,c] = np.clip(alpha*im[y,x,c] + beta, 0, 255)
+    return im
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+parser = argparse.ArgumentParser(description='Benchmark imtools contrast adjustment.')
+parser.add_argument('--size', type=int, default=3660, help='Tile width/height in pixels (HLS: 3660).')
+parser.add_argument('--rows', type=int, default=64, help='Rows the per-pixel loop is timed on.')
+parser.add_argument('--full', action='store_true', help='Run the per-pixel loop on the full tile.')
+parser.add_argument('--times', type=int, default=4, help='Observations in the time series benchmark.')
+args = parser.parse_args()
+
+alpha, beta = 1.4, 0    #contrast.emphasize
+rng = np.random.default_rng(0)
+
+for dtype in (np.float64, np.uint8):
+    tile = (rng.random((args.size, args.size, 3)) * 255).astype(dtype)
+
+    rows = args.size if args.full else min(args.rows, args.size)
+    expected, loop_time = timed(scale_alpha_beta_loop, tile[:rows].copy(), alpha, beta)
+    loop_time *= args.size / rows
+
+    result, vector_time = timed(scale_alpha_beta, tile, alpha, beta)
+    assert np.array_equal(result[:rows], expected)
+
+    out = np.empty_like(tile)
+    _, out_time = timed(scale_alpha_beta, tile, alpha, beta, out)
+
+    print(f"{np.dtype(dtype).name} {args.size}x{args.size}x3 tile:")
+    print(f"  per-pixel loop   {loop_time:10.2f} s{'' if args.full else f' (scaled from {rows} rows)'}")
+    print(f"  in place         {vector_time:10.4f} s   {loop_time/vector_time:,.0f}x faster")
+    print(f"  out=             {out_time:10.4f} s   {loop_time/out_time:,.0f}x faster")
+
+series = (rng.random((args.times, args.size, args.size, 3)) * 255).astype(np.float32)
+_, series_time = timed(scale_alpha_beta, series, alpha, beta)
+print(f"float32 ({args.times},{args.size},{args.size},3) time series in one pass: {series_time:.4f} s")
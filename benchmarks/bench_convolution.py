@@ -0,0 +1,78 @@
+#bench_convolution.py
+#
+#Times imtools.convolve (each engine, and the one 'auto' picks) against the
+#  scipy.ndimage.convolve path imtools used for every kernel, on a full
+#  3660x3660 HLS band and on a small (time,y,x,band) time series. Every result
+#  is checked against scipy.ndimage.convolve first.
+#
+#Usage: python benchmarks/bench_convolution.py [--size 3660] [--times 4] [--repeat 1]
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from imtools import convolve, kernel, fft_threshold
+
+def timed(function, *args, repeat=1, **kwargs):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+parser = argparse.ArgumentParser(description='Benchmark imtools convolution engines.')
+parser.add_argument('--size', type=int, default=3660, help='Band width/height in pixels (HLS: 3660).')
+parser.add_argument('--times', type=int, default=4, help='Observations in the time series benchmark.')
+parser.add_argument('--repeat', type=int, default=1, help='Runs per timing (the best one is kept).')
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+kernels = {'high_pass 3x3': kernel.high_pass,
+           'box 5x5':       kernel.box(5),
+           'box 31x31':     kernel.box(31),
+           'gaussian s=2':  kernel.gaussian(2),
+           'gaussian s=8':  kernel.gaussian(8),
+           'random 7x7':    rng.random((7,7)),
+           'random 25x25':  rng.random((25,25))}
+
+def engines(weights):
+    names = ['direct', 'fft']
+    if np.linalg.matrix_rank(weights) == 1:
+        names.insert(0, 'separable')
+    return names
+
+def auto_engine(weights):
+    if np.linalg.matrix_rank(weights) == 1:
+        return 'separable'
+    return 'direct' if weights.size <= fft_threshold else 'fft'
+
+band = rng.random((1, args.size, args.size)) * 10000
+print(f"(1,{args.size},{args.size}) band, seconds (speedup over ndimage.convolve):")
+for name, weights in kernels.items():
+    expected, base_time = timed(ndimage.convolve, band, weights[np.newaxis], mode='reflect', repeat=args.repeat)
+    line = f"  {name:14s} ndimage {base_time:8.3f}"
+    for engine in engines(weights):
+        result, engine_time = timed(convolve, band, weights, engine, repeat=args.repeat)
+        assert np.allclose(result, expected, rtol=1e-9, atol=1e-6), (name, engine)
+        line += f"   {engine} {engine_time:7.3f} ({base_time/engine_time:5.1f}x)"
+    print(line + f"   auto: {auto_engine(weights)}")
+
+cube = rng.random((args.times, args.size//4, args.size//4, 3)) * 10000
+print(f"({args.times},{args.size//4},{args.size//4},3) time series, axes=(1,2):")
+for name in ['gaussian s=2', 'random 25x25']:
+    weights = kernels[name]
+    expected, base_time = timed(ndimage.convolve, cube, weights[np.newaxis,:,:,np.newaxis], mode='reflect', repeat=args.repeat)
+    result, auto_time = timed(convolve, cube, weights, axes=(1,2), repeat=args.repeat)
+    assert np.allclose(result, expected, rtol=1e-9, atol=1e-6), name
+    print(f"  {name:14s} ndimage {base_time:8.3f}   auto {auto_time:7.3f} ({base_time/auto_time:5.1f}x)")
+
+nodata = band.copy()
+nodata[:, rng.random(band.shape[1:]) < 0.05] = np.nan
+_, nan_time = timed(convolve, nodata, kernel.gaussian(2), repeat=args.repeat)
+print(f"gaussian s=2 with 5% NaN nodata (normalized): {nan_time:.3f} s")
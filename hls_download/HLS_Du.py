@@ -14,104 +14,31 @@ Last Updated:
 
 
 # Define the script as a function and use the inputs provided by HLS_SuPER.py:
-def hls_download(tileIDs, outDir, dates, prods, band_dict, cc):
+#  Searches by MGRS tile instead of by bbox. tileIDs is a list of tile IDs (e.g. ['10SEG', 'T10SFG']),
+#  or a GeoDataFrame ROI that is resolved to the tiles it falls in with find_tiles.find_MGRS_tiles.
+#  Every tile and product is queried concurrently (with the tile's footprint as bbox), and only the
+#  items of the requested tiles are kept, without duplicates (see HLS_Su.hls_subset).
+def hls_download(tileIDs, outDir, dates, prods, band_dict, cc, endpoint=None, workers=8, cache=None):
     
     # Load necessary packages into Python
-    import os
-    import requests as r
     import sys
+    import geopandas as gp
+    from find_tiles import find_MGRS_tiles, tile_bboxes
+    from HLS_Su import hls_subset
 
-    # ------------------------------SET-UP WORKSPACE------------------------- #
-    # Change the working directory
-    os.chdir(outDir)
-    
-    # CMR-STAC API Endpoint for LP DAAC search 
-    lp_stac = 'https://cmr.earthdata.nasa.gov/stac/LPCLOUD/search?'   
-    
-    # ------------------------------PERFORM SEARCH QUERY--------------------- #
-    bandLinks = [] # Create an empty list to save the output URLs
-    num_tiles = 0
+    # ------------------------------RESOLVE TILES---------------------------- #
+    # A region of interest becomes the exact tiles it falls in
+    if isinstance(tileIDs, gp.GeoDataFrame):
+        tileIDs = find_MGRS_tiles(tileIDs)
+        if tileIDs is None:
+            sys.exit()
 
-    for b in band_dict:        
-        page = 1
-        # Attempt to access STAC up to 3 times
-        for retry in range(0,3):
-            
-            # Set up a search query dictionary with all the desired query parameters
-            tileIDs = ','.join(map(str,[tileIDs[0]]))
-            params = {"MGRS_TILE_ID": tileIDs, "limit": 100, "datetime": dates, "collections": [prods[b]], "page": page}
-            #search_query = f"{lp_stac}&collections={prods[b]}&bbox={bbox_string}&datetime={dates}&limit={limit}&page={page}"
-            # Post params dict to the CMR-STAC search endpoint
-            breakpoint()
-            if r.post(lp_stac, json=params).status_code == 200:        # Check status code for successful query or not
-                search_response = r.post(lp_stac, json=params).json()  # Send GET request to retrieve items
-                if len(search_response['features']) == 0:     # Raise warning to users that no intersecting files were found
-                    print(f'There were no matching outputs found for {b} (Attempt: {retry + 1} of 3)')
-                    continue
-                else:
-                    print(f'There are matching outputs found for {b}')
-                    while search_response['numberReturned'] != 0:
-                        # Iterate through each item and find the desired assets (layers)
-                        for h in search_response['features']:
-                            
-                            # Filter by cloud cover
-                            if h['properties']['eo:cloud_cover'] <= cc:
-                                try:
-                                    # Always include browse, metadata, and fmask (QA)
-                                    bandLinks.append(h['assets']['browse']['href']) 
-                                    bandLinks.append(h['assets']['metadata']['href'])
-                                    bandLinks.append(h['assets']['Fmask']['href'])
-                                    num_tiles += 1
-                                except:
-                                    print(f"Browse, metadata, and/or Fmask assets were unavailable for {h}")
-                                
-                                # Now find the desired bands/layers
-                                for l in band_dict[b]:
-                                    
-                                    # Don't duplicate FMASK
-                                    if l == 'FMASK': continue
-                                
-                                    # Skip a single band (asset) if it does not exist for that item
-                                    try: 
-                                        # Add output links to the list
-                                        bandLinks.append(h['assets'][band_dict[b][l]]['href']) 
-                                    except:
-                                        print(f'{b} band is not available for {h["id"]}') 
-                        
-                        # Move to the next page until all granules are found
-                        page += 1
-                        params['page'] = page
-                        search_response = r.post(lp_stac, json=params).json()  # Send GET request to retrieve items
-                    break
-            # Attempt to find the source of an unsuccessful query 
-            else:                                                      
-                if r.post(lp_stac).status_code != 200: 
-                    print(f"ERROR: The CMR-STAC Service is either down or you may not be connected to the internet. (Attempt {retry+1} of 3)")
-                elif r.post(lp_stac, json={"MGRS_TILE_ID": tileIDs, "limit": 100, "collections": [prods[b]]}).status_code != 200:
-                    print(f"ERROR: The ROI was rejected by the server. (Attempt {retry+1} of 3)")
-                else:
-                    print(f"ERROR: The start and/or end dates were rejected by the server. (Attempt {retry+1} of 3)") 
+    # Accept a comma separated string of tiles as well
+    elif isinstance(tileIDs, str):
+        tileIDs = tileIDs.split(',')
 
-    print(f"\n{num_tiles} granules intersect with your query including {len(bandLinks)} downloadable files.")
-    
-    # Exit script if no intersecting files found
-    if num_tiles == 0:
-        sys.exit()
-        
-    print("Links to those files are saved in the file below:")    
-    # Save the links in a text file 
-    out_file = f"{outDir}HLS_SuPER_links.txt"
-    with open(out_file, "w") as output:
-        for link in bandLinks:
-            output.write(f'{link}\n')
-    print(out_file)
-        
-    # Ask user if they would like to continue with processing or exit
-    dl = input("Would you like to continue downloading these files? (y/n):")
-    
-    return dl  # Return response to HLS_SuPER.py
-
-
-
-from cmr import CollectionQuery
+    tiles = tile_bboxes(tileIDs)
+    print(f"Searching {len(tiles)} MGRS tile(s): {', '.join(tiles)}")
 
+    # ------------------------------PERFORM SEARCH QUERY--------------------- #
+    return hls_subset(None, outDir, dates, prods, band_dict, cc, endpoint=endpoint, workers=workers, cache=cache, tiles=tiles)
@@ -13,38 +13,432 @@ Last Updated: 01-29-2021
 ===============================================================================
 """
 
-import sys, os
-def errMessage(file,retry):
-    exc_type, exc_obj, exc_tb = sys.exc_info()
+import sys, os, threading
+def errMessage(file,retry,exc=None):
+    import re
+    import traceback
+    if exc is None:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+    else:
+        exc_type, exc_obj, exc_tb = type(exc), exc, exc.__traceback__  # Exceptions handed back by a worker pool
     if exc_type == KeyboardInterrupt:
         raise(KeyboardInterrupt)
     else:
         exc_name = str(exc_type); exc_name = exc_name[exc_name.rfind(".")+1:exc_name.rfind("'")] 
-        print(f"\nUnable to process item {file}. Unexpected {exc_name} on line {exc_tb.tb_lineno} of {os.path.basename(__file__)}: \n{str(exc_obj)} (Attempt {retry+1} of 3)")
+        # Report the frame that raised, not the one that caught it (future.result() for pool errors)
+        frame = traceback.extract_tb(exc_tb)[-1]
+        file_name, line = os.path.basename(frame.filename), frame.lineno
+        # A process pool only hands back the worker's traceback as text
+        remote = getattr(getattr(exc_obj, '__cause__', None), 'tb', None)
+        if isinstance(remote, str):
+            frames = re.findall(r'File "(.+)", line (\d+)', remote)
+            if frames:
+                file_name, line = os.path.basename(frames[-1][0]), frames[-1][1]
+        print(f"\nUnable to process item {file}. Unexpected {exc_name} on line {line} of {file_name}: \n{str(exc_obj)} (Attempt {retry+1} of 3)")
+
+# GDAL configs used to successfully access LP DAAC Cloud Assets via vsicurl
+gdal_config = {'GDAL_HTTP_UNSAFESSL': 'YES',
+               'GDAL_HTTP_COOKIEFILE': os.path.expanduser('~/cookies.txt'),
+               'GDAL_HTTP_COOKIEJAR': os.path.expanduser('~/cookies.txt'),
+               'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',        # Don't list the remote directory on every open
+               'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': 'TIF',
+               'GDAL_HTTP_NETRC': 'YES',                           # Earthdata Login credentials come from the netrc
+               'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',        # Fetch adjacent COG tiles in a single range request
+               'GDAL_HTTP_MAX_RETRY': '3',
+               'GDAL_HTTP_RETRY_DELAY': '2'}
+
+# HLS V2.0 Fmask bit positions (section 6.4 of the HLS V2.0 User Guide)
+fmask_bits = {'CIRRUS': 0, 'CLOUD': 1, 'ADJACENT': 2, 'SHADOW': 3, 'SNOW': 4, 'WATER': 5}
+
+# Aerosol level is stored in bits 6-7. Filtering on a level removes that level and above.
+aerosol_levels = {'AEROSOL-LOW': 1, 'AEROSOL-MODERATE': 2, 'AEROSOL-HIGH': 3}
+
+# Build a 256-entry lookup table that is True for every Fmask value to be filtered out.
+#  Indexing it with a uint8 Fmask array (lut[qa]) decodes the whole array in one pass.
+#  The default (Cloud = No and Cloud Shadow = No) matches the original quality filter.
+def fmask_lut(filters=('CLOUD', 'SHADOW')):
+    import numpy as np
+    values = np.arange(256)
+    lut = np.zeros(256, dtype=bool)
+    for f in filters:
+        if f in fmask_bits:
+            lut |= (values >> fmask_bits[f]) & 1 == 1
+        elif f in aerosol_levels:
+            lut |= (values >> 6) >= aerosol_levels[f]
+        else:
+            raise ValueError(f"{f} is not a valid Fmask filter. Valid filters are {', '.join(list(fmask_bits) + list(aerosol_levels))}.")
+    return lut
+
+# Download one file, failing on HTTP errors so error pages never end up on disk or in the cache
+#  The file is streamed to file_path + '.part' and only renamed to file_path once complete. With
+#  resume=True, a .part file left by an interrupted run is continued with an HTTP Range request
+#  (the server may still send the whole file). Returns the SHA-256 checksum of the file.
+def download_file(url, file_path, verify=True, resume=False):
+    import requests as r
+    import hashlib
+    part = file_path + '.part'
+    checksum = hashlib.sha256()
+    headers = {}
+    if resume and os.path.exists(part):
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                checksum.update(chunk)
+        headers['Range'] = f"bytes={os.path.getsize(part)}-"
 
-# Define the script as a function and use the inputs provided by HLS_SuPER.py:
-def hls_process(outDir, ROI, qf, scale, of, nd, fileList):
-    ######################### IMPORT PACKAGES #################################
-    import rasterio as rio
-    from osgeo import gdal
+    try:
+        with r.get(url, verify=verify, headers=headers, stream=True) as response:
+            # Nothing left to download: the .part file already holds the whole file
+            if response.status_code == 416 and response.headers.get('Content-Range') == f"bytes */{os.path.getsize(part)}":
+                os.replace(part, file_path)
+                return checksum.hexdigest()
+            response.raise_for_status()
+            if response.status_code != 206:
+                checksum = hashlib.sha256()  # Not resumed, start over
+            with open(part, 'ab' if response.status_code == 206 else 'wb') as downloaded_file:
+                for chunk in response.iter_content(2**20):
+                    downloaded_file.write(chunk)
+                    checksum.update(chunk)
+    except:
+        if not resume and os.path.exists(part):
+            os.remove(part)
+        raise
+    os.replace(part, file_path)
+    return checksum.hexdigest()
+
+# Download the Fmask and band files for one tile-time (runs in the I/O thread pool)
+#  With a cache (hls_cache.cache), files already cached are linked into outDir instead of downloaded.
+#  With a manifest (hls_manifest.manifest), files finished in an earlier run are kept, partial
+#  downloads are resumed, and every finished file is recorded.
+def download_granule(granule_files, outDir, cache=None, manifest=None):
+    local_files = []
+    for file in granule_files:
+        local_name = outDir + file.rsplit('/', 1)[-1]
+        if manifest is not None and manifest.asset(file) == local_name:
+            pass  # Downloaded in an earlier run
+        elif cache is None:
+            if manifest is not None: manifest.set_asset(file, 'partial', local_name)
+            sha256 = download_file(file, local_name, resume=manifest is not None)
+            if manifest is not None: manifest.set_asset(file, 'downloaded', local_name, sha256)
+        else:
+            cache.link_asset(file, local_name, lambda url, file_path: download_file(url, file_path, resume=True))
+            if manifest is not None: manifest.set_asset(file, 'downloaded', local_name)
+        local_files.append(local_name)
+    return local_files
+
+# Processing workers are forked (on Linux) before any download thread starts. Every worker waits
+#  here until all of them are running, so none is forked later, from a process with threads.
+worker_barrier = None
+
+def wait_for_workers():
+    worker_barrier.wait(timeout=60)
+
+# In window mode, point GDAL at the remote COGs directly. rasterio.mask.mask with crop=True
+#  only reads the window that intersects the ROI, so GDAL fetches just those internal tiles
+#  (plus the header) over HTTP range requests and nothing is written to disk.
+def remote_granule(granule_files):
+    return [f"/vsicurl/{file}" for file in granule_files]
+
+# ROI reprojections and raster masks, cached for the life of a worker process. HLS only spans a
+#  few dozen UTM zones and every granule of an MGRS tile is on the same grid, so after the first
+#  granule of a tile, the ROI is neither reprojected nor rasterized again.
+roi_transformers = {}  # CRS: Transformer from geographic coordinates
+roi_projections = {}   # (CRS, ROI): ROI in that CRS
+roi_masks = {}         # (CRS, ROI, grid): (mask of the pixels outside the ROI, transform, window)
+roi_cache_size = 256   # Entries kept per cache, the oldest are dropped first (see size_roi_caches)
+roi_cache_lock = threading.Lock()  # Processing falls back to threads on Windows
+
+def cache_put(cache, key, value):
+    with roi_cache_lock:
+        while len(cache) >= roi_cache_size:
+            del cache[next(iter(cache))]
+        cache[key] = value
+    return value
+
+# Keep enough cache entries for every feature of a multi-feature ROI. Entries are keyed per feature
+#  and a feature rarely spans more than a few MGRS tiles (grids) and UTM zones, so with a slot for
+#  each, a tile's features are still cached when its next granule comes around.
+def size_roi_caches(n_features):
+    global roi_cache_size
+    roi_cache_size = max(roi_cache_size, 4*n_features)
+
+# Reproject a geographic (EPSG:4326) ROI geometry to crs
+def project_roi(roi, crs, key=None):
     import pyproj
     from shapely.ops import transform
+
+    wkt = crs.to_wkt()
+    key = (wkt, roi.wkb) if key is None else key
+    roi_UTM = roi_projections.get(key)
+    if roi_UTM is not None:
+        return roi_UTM
+
+    transformer = roi_transformers.get(wkt)
+    if transformer is None:
+        geo_CRS = pyproj.Proj('+proj=longlat +datum=WGS84 +no_defs', preserve_units=True)
+        transformer = cache_put(roi_transformers, wkt, pyproj.Transformer.from_proj(geo_CRS, pyproj.Proj(crs)))  # Set up src -> dest transformation
+    roi_UTM = transform(transformer.transform, roi)  # Apply reprojection to ROI
+    if roi_UTM.has_z:                                # Remove the third dimension if there is 1
+        roi_UTM = transform(lambda x, y, z = None: (x, y), roi_UTM)
+    return cache_put(roi_projections, key, roi_UTM)
+
+# Mask of the pixels of a dataset's grid outside a geographic ROI, with the transform and window of
+#  the ROI's bounding box (rasterio.mask.raster_geometry_mask with crop=True). Raises ValueError if
+#  the ROI doesn't overlap the dataset.
+def roi_mask(dataset, roi):
+    from rasterio.mask import raster_geometry_mask
+
+    projection = (dataset.crs.to_wkt(), roi.wkb)
+    key = projection + (dataset.transform, dataset.width, dataset.height)
+    mask = roi_masks.get(key)
+    if mask is None:
+        roi_UTM = project_roi(roi, dataset.crs, projection)
+        mask = cache_put(roi_masks, key, raster_geometry_mask(dataset, [roi_UTM], crop=True))
+    return mask
+
+# Read the ROI window of a dataset with the pixels outside the ROI set to nodata, as
+#  rasterio.mask.mask(crop=True) does, but with the ROI mask from the cache.
+def read_roi(dataset, roi):
+    shape_mask, roi_transform, window = roi_mask(dataset, roi)
+    subset = dataset.read(window=window, out_shape=(dataset.count,) + shape_mask.shape)
+    subset[:, shape_mask] = dataset.nodata if dataset.nodata is not None else 0
+    return subset, roi_transform
+
+# Subset, quality filter, scale and export one tile-time as COGs (runs in the processing pool)
+#  qa_lut is the fmask_lut() to quality filter with, or None to skip quality filtering.
+#  roi_shape is one geometry, exported to outDir, or {subfolder: geometry} for several ROI features
+#  (see hls_process), each exporting the part of the granule it overlaps to outDir + subfolder; the
+#  source files are opened once for all of them.
+#  Returns the exported file names, or the percent of noData if the granule was excluded.
+def process_granule(granule_files, roi_shape, qa_lut, scale, nd, outDir):
+    import rasterio as rio
     from shapely.geometry import box
-    import shapely
-    from rasterio.mask import mask
-    from rasterio.shutil import copy
+    from shapely.prepared import prep
+    from rasterio.warp import transform_bounds
     import numpy as np
+
+    with rio.Env(**gdal_config):
+        outputs = []
+        percents = []  # Percent of noData of each excluded feature
+
+        # Read Quality band, then open the other layers once for every feature
+        qa = rio.open([file for file in granule_files if 'Fmask' in file][0])
+        bands = [rio.open(b) for b in granule_files if 'Fmask' not in b]
+
+        # Only the features that overlap this granule are subset from it
+        if isinstance(roi_shape, dict):
+            size_roi_caches(len(roi_shape))
+            footprint = prep(box(*transform_bounds(qa.crs, 'EPSG:4326', *qa.bounds)))
+            rois = {folder: roi for folder, roi in roi_shape.items() if footprint.intersects(roi)}
+        else:
+            rois = {'': roi_shape}
+
+        for folder, roi in rois.items():
+            # Subset the fmask quality data (returned by default), with the ROI in the scene's UTM zone
+            try:
+                qa_subset, qa_transform = read_roi(qa, roi)
+            except ValueError:
+                if folder == '': raise
+                continue  # The feature only overlaps the granule's footprint in geographic coordinates
+
+            #Pass on htis dataset if the percent of noData is below user threshold
+            pixels = qa_subset.shape[1]*qa_subset.shape[2]
+            noData = len(qa_subset[qa_subset==255])
+            percentNoData = (noData/pixels)*100
+            if percentNoData > nd:
+                percents.append(percentNoData)
+                continue
+
+            # Decode the Fmask once into a mask of pixels to filter, reused for every band
+            qa_mask = qa_lut[qa_subset] if qa_lut is not None else None
+
+            originalName = os.path.basename(qa.name) # If only exporting FMASK, use for original name
+
+            # Loop through and process all other layers (excluding QA)
+            for band in bands:
+
+                # Load in subset
+                subset, btransform = read_roi(band, roi)
+
+                # Filter by quality if desired
+                if qa_mask is not None:
+                    # Apply QA mask and set masked data to fill value
+                    np.putmask(subset, qa_mask, band.meta['nodata'])
+
+                # Apply scale factor if desired
+                if scale is True:
+                    subset = subset[0] * band.scales[0]  # Apply Scale Factor
+
+                    try:
+                        # Reset the fill value
+                        subset[subset == band.meta['nodata'] * band.scales[0]] = band.meta['nodata']
+                    except TypeError:
+                        print(f"Fill Value is not provided for band {band.name.rsplit('.', 2)[-2]}")
+                else:
+                    subset = subset[0]
+
+                ################# EXPORT AS COG ###########################
+                # Grab the original HLS S30 granule name
+                originalName = os.path.basename(band.name)
+                bandName = band.name.rsplit('.', 2)[-2]
+
+                # Generate output name from the original filename
+                outName = f"{outDir}{folder}{originalName.split('.v2.0.')[0]}.v2.0.{bandName}.subset.tif"
+
+                # Export the scaled, quality filtered band with overviews from the source data
+                write_cog(subset, outName, band.crs, btransform, band.meta['nodata'], band.overviews(1))
+
+                outputs.append(outName)  # Update list of outputs
+
+            # Export quality layer (Fmask)
+            outName = f"{outDir}{folder}{originalName.split('.v2.0.')[0]}.v2.0.Fmask.subset.tif"
+            write_cog(qa_subset[0], outName, qa.crs, qa_transform, qa.meta['nodata'], qa.overviews(1))
+            outputs.append(outName)
+
+        for band in bands: band.close()
+        qa.close()
+
+        # Excluded only if none of the features were exported
+        if not outputs:
+            return {'outputs': outputs, 'percentNoData': min(percents, default=100.0)}
+        return {'outputs': outputs, 'percentNoData': None}
+
+# Export one band as a Cloud Optimized GeoTIFF. The GeoTIFF and its overviews are built in
+#  memory (no temp file), then copied once to outName with tiling and LZW compression.
+#  Nothing is shared between calls, so several workers can export at the same time.
+def write_cog(array, outName, crs, transform, nodata, overviews):
+    from rasterio.io import MemoryFile
+    from rasterio.shutil import copy
     from rasterio.enums import Resampling
-    import requests as r
+
+    with MemoryFile() as memfile:
+        # Create in-memory GeoTIFF with overviews
+        with memfile.open(driver='GTiff', height=array.shape[0], width=array.shape[1], count=1, dtype=str(array.dtype), crs=crs, transform=transform, nodata=nodata) as out_tif:
+            out_tif.write(array, 1)
+            out_tif.build_overviews(overviews, Resampling.average)      # Calculate overviews
+            out_tif.update_tags(ns='rio_overview', resampling='average') # Update tags
+
+        # Add tiling and compression, and export as valid COG
+        with memfile.open() as src:
+            copy(src, outName, driver='GTiff', tiled=True, blockxsize=256, blockysize=256, compress='LZW', copy_src_overviews=True)
+
+# Download one ancillary (browse/metadata) file (runs in the I/O thread pool)
+def download_ancillary(a, cache=None):
+    if cache is None:
+        import requests as r
+        a_content = r.get(a, verify=False).content
+    else:
+        with open(cache.fetch_asset(a, lambda url, file_path: download_file(url, file_path, verify=False, resume=True)), 'rb') as cached:
+            a_content = cached.read()
+    if a.endswith('.xml'):
+        newName = a_content[a_content.find(b'<GranuleUR>')+11:a_content.find(b'</GranuleUR>')].decode() + '.metadata.xml'
+    else:
+        newName = a.rsplit('/', 1)[-1]
+    with open(newName, 'wb') as handler:
+        handler.write(a_content)
+    return newName
+
+# Split a subset COG name (HLS.S30.T10SEG.2021001T184919.v2.0.B04.subset.tif) into its
+#  tile, acquisition time and band.
+def cog_name(c):
+    from datetime import datetime
+    parts = os.path.basename(c).split('.')
+    return parts[2], datetime.strptime(parts[3], '%Y%jT%H%M%S'), parts[-3]
+
+# Stack one tile's subset COGs into a single CF-compliant (1.6) NC4 or ZARR file, one observation
+#  at a time. The first observation creates the file and every later one is appended along an
+#  unlimited time dimension, so only one observation is ever held in memory and the cost grows
+#  linearly with the number of observations. Bands missing from an observation are written as fill.
+def stack_cogs(cogs, outName, of):
+    import rasterio as rio
+    import numpy as np
+    import xarray as xr
+
+    # Index the COGs by acquisition time and band
+    obs = {}
+    for c in cogs:
+        tile, time, band = cog_name(c)
+        obs.setdefault(time, {})[band] = c
+    times = sorted(obs)
+    variables = sorted({v for o in obs.values() for v in o})
+
+    # Grid, data type and fill value of every variable, from the first file that has it
+    meta = {}
+    for v in variables:
+        with rio.open(next(obs[t][v] for t in times if v in obs[t])) as src:
+            meta[v] = src.profile
+    profile = meta[variables[0]]
+    ny, nx, transform = profile['height'], profile['width'], profile['transform']
+    chunks = (1, min(ny, 512), min(nx, 512))  # A whole number of the 256x256 COG blocks per chunk
+
+    def read(t, v):
+        if v not in obs[t]:
+            return np.full((ny, nx), meta[v]['nodata'], meta[v]['dtype'])
+        with rio.open(obs[t][v]) as src:
+            return src.read(1)
+
+    # Dataset holding a single observation
+    def observation(t):
+        data = {}
+        for v in variables:
+            data[v] = xr.Variable(('time', 'lat', 'lon'), read(t, v)[np.newaxis],
+                                  attrs={'standard_name': v, 'long_name': f"HLS {v}", 'grid_mapping': 'spatial_ref', 'units': 'None'})
+        ds = xr.Dataset(data, coords={'time': ('time', [np.datetime64(t, 'ns')], {'axis': 'Z', 'standard_name': 'time', 'long_name': 'time'})})
+        ds.attrs.update({'Conventions': 'CF-1.6', 'title': 'HLS', 'nc.institution': 'Unidata', 'source': 'LP DAAC'})
+        return ds
+
+    # The first observation also carries the (pixel center) coordinates and the CRS
+    ds = observation(times[0])
+    x = transform.c + (np.arange(nx) + 0.5) * transform.a
+    y = transform.f + (np.arange(ny) + 0.5) * transform.e
+    ds = ds.assign_coords({
+        'lon': ('lon', x, {'units': 'degrees_east', 'standard_name': 'longitude', 'long_name': 'longitude'}),
+        'lat': ('lat', y, {'units': 'degrees_north', 'standard_name': 'latitude', 'long_name': 'latitude'}),
+        'x': ('lon', x, {'axis': 'X', 'standard_name': 'x', 'long_name': 'x-coordinate in projected coordinate system', 'units': 'm'}),
+        'y': ('lat', y, {'axis': 'Y', 'standard_name': 'y', 'long_name': 'y-coordinate in projected coordinate system', 'units': 'm'}),
+        'spatial_ref': ((), 0, {'grid_mapping_name': 'transverse_mercator', 'spatial_ref': profile['crs'].to_wkt(), 'standard_name': 'CRS'})})
+    encoding = {v: {'_FillValue': meta[v]['nodata'], 'missing_value': meta[v]['nodata']} for v in variables}
+    encoding['time'] = {'units': 'seconds since 1970-01-01', 'calendar': 'standard', 'dtype': 'int64'}
+
+    if of == 'NC4':
+        import netCDF4
+        for v in variables:
+            encoding[v]['chunksizes'] = chunks
+        ds.to_netcdf(outName, unlimited_dims=['time'], encoding=encoding)
+        with netCDF4.Dataset(outName, 'a') as nc:
+            for i, t in enumerate(times[1:], 1):
+                nc['time'][i] = netCDF4.date2num(t, nc['time'].units, nc['time'].calendar)
+                for v in variables:
+                    nc[v][i] = read(t, v)
+    else:
+        for v in variables:
+            encoding[v]['chunks'] = chunks
+        ds.to_zarr(outName, mode='w', encoding=encoding)
+        for t in times[1:]:
+            observation(t).to_zarr(outName, append_dim='time')
+
+# Define the script as a function and use the inputs provided by HLS_SuPER.py:
+#  workers sets how many granules are downloaded (threads) and processed (processes) at once.
+#  access='window' reads only the ROI window of each remote COG instead of downloading it.
+#  cache is an optional hls_cache.cache that downloaded assets are read from and saved to.
+#  qa_filters are the Fmask conditions (see fmask_lut) removed when qf is True.
+#  features='all' clips every feature of a multi-feature ROI file from the same granules, each
+#  into its own feature_<n> subfolder of outDir, instead of only the first feature.
+def hls_process(outDir, ROI, qf, scale, of, nd, fileList, workers=1, access='download', cache=None, qa_filters=('CLOUD', 'SHADOW'), features='first'):
+    ######################### IMPORT PACKAGES #################################
+    from osgeo import gdal
+    from shapely.geometry import box
+    import shapely
     import geopandas as gp
     from netrc import netrc
     from subprocess import Popen
     from subprocess import DEVNULL, STDOUT
     from getpass import getpass
-    from pyproj import CRS
-    from datetime import datetime
     import warnings
     from sys import platform
+    import multiprocessing as mp
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from hls_manifest import manifest
+    import hashlib
 
     ######################### HANDLE INPUTS ###################################
     os.chdir(outDir)
@@ -72,9 +466,9 @@ def hls_process(outDir, ROI, qf, scale, of, nd, fileList):
 
     # Convert bbox, shapefile, or geojson (from input args) to shapely polygon
     if ROI.endswith('.shp') or ROI.endswith('json'):
-        if len(gp.read_file(ROI)['geometry']) > 1:
-            print('Multi-feature polygon detected. This script will only process the first feature.')
         bbox = gp.read_file(ROI)
+        if len(bbox['geometry']) > 1 and features == 'first':
+            print('Multi-feature polygon detected. This script will only process the first feature.')
 
         # Check if ROI is in Geographic CRS, if not, convert to it
         if bbox.crs.is_geographic:
@@ -86,7 +480,7 @@ def hls_process(outDir, ROI, qf, scale, of, nd, fileList):
     elif ROI.endswith('.kml'):
         #gp.io.file.fiona.drvsupport.supported_drivers['KML'] = 'rw'
         bbox = gp.read_file(ROI,driver='KML')
-        if len(bbox['geometry']) > 1:
+        if len(bbox['geometry']) > 1 and features == 'first':
             print('Multi-feature polygon detected. This script will only process the first feature.')
         roi_shape = bbox['geometry'][0]
     else:
@@ -96,13 +490,16 @@ def hls_process(outDir, ROI, qf, scale, of, nd, fileList):
     if type(roi_shape) ==  shapely.geometry.collection.GeometryCollection:
         roi_shape == roi_shape.geoms[0]
 
+    # Each feature of a multi-feature ROI is clipped from the shared granules into its own subfolder
+    if features == 'all' and isinstance(bbox, gp.GeoDataFrame) and len(bbox) > 1:
+        roi_shape = {f"feature_{i}{os.sep}": g for i, g in enumerate(bbox['geometry'])}
+        for folder in roi_shape:
+            os.makedirs(f"{outDir}{folder}", exist_ok=True)
+
     ######################## AUTHENTICATION ###################################
     # GDAL configs used to successfully access LP DAAC Cloud Assets via vsicurl
-    gdal.SetConfigOption("GDAL_HTTP_UNSAFESSL", "YES")
-    gdal.SetConfigOption('GDAL_HTTP_COOKIEFILE','~/cookies.txt')
-    gdal.SetConfigOption('GDAL_HTTP_COOKIEJAR', '~/cookies.txt')
-    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN','FALSE')
-    gdal.SetConfigOption('CPL_VSIL_CURL_ALLOWED_EXTENSIONS','TIF')
+    for key, value in gdal_config.items():
+        gdal.SetConfigOption(key, value)
 
     # Verify a netrc is set up with Earthdata Login Username and password
     urs = 'urs.earthdata.nasa.gov'    # Earthdata URL to call for authentication
@@ -113,6 +510,8 @@ def hls_process(outDir, ROI, qf, scale, of, nd, fileList):
         nrc = '_netrc'
     else:
         nrc = '.netrc'
+    gdal_config['GDAL_HTTP_NETRC_FILE'] = os.path.expanduser(f"~/{nrc}")
+    gdal.SetConfigOption('GDAL_HTTP_NETRC_FILE', gdal_config['GDAL_HTTP_NETRC_FILE'])
     try:
         netrcDir = os.path.expanduser(f"~/{nrc}")
         netrc(netrcDir).authenticators(urs)[0]
@@ -144,284 +543,157 @@ def hls_process(outDir, ROI, qf, scale, of, nd, fileList):
     del urs, prompts
 
     ######################## PROCESS FILES ####################################
-    # Define source CRS of the ROI
-    geo_CRS = pyproj.Proj('+proj=longlat +datum=WGS84 +no_defs', preserve_units=True)
     all_cogs = []
     z = 0
+    qa_lut = fmask_lut(qa_filters) if qf is True else None
+
+    # Record the run in a manifest, so running it again (e.g. after an interruption) only does what is left
+    #  The ROI is identified by its geometry, so editing the ROI file in place doesn't reuse old subsets
+    roi_digest = hashlib.sha256()
+    for geom in (roi_shape.values() if isinstance(roi_shape, dict) else [roi_shape]):
+        roi_digest.update(geom.wkb)
+    job = manifest(f"{outDir}HLS_SuPER_manifest.db", [ROI, roi_digest.hexdigest(), qf, scale, nd, list(qa_filters), features])
+
+    # Downloads run in a thread pool; subsetting/filtering/exporting runs in a process pool.
+    #  Forking keeps the HLS_SuPER.py script from being re-executed in every worker. Fork is only
+    #  safe on Linux (not on macOS, where system libraries don't support it), so everywhere else
+    #  the processing runs in threads.
+    global worker_barrier
+    if platform.startswith('linux'):
+        fork = mp.get_context('fork')
+        worker_barrier = fork.Barrier(workers)
+        cpu_pool = ProcessPoolExecutor(max_workers=workers, mp_context=fork)
+        # Start every worker before any download thread exists
+        for started in [cpu_pool.submit(wait_for_workers) for _ in range(workers)]:
+            started.result()
+    else:
+        cpu_pool = ThreadPoolExecutor(max_workers=workers)
+    io_pool = ThreadPoolExecutor(max_workers=workers)
+
+    # Each pending future maps to (stage, tile_time, attempt). Try to access each item/asset 3 times.
+    pending = {}
+    def submit_granule(f, retry):
+        if access == 'window':
+            pending[cpu_pool.submit(process_granule, remote_granule(file_dict[f]), roi_shape, qa_lut, scale, nd, outDir)] = ('process', f, retry)
+        else:
+            pending[io_pool.submit(download_granule, file_dict[f], outDir, cache, job)] = ('download', f, retry)
+
+    # Add tile-times that keep failing to a list, otherwise start the tile-time over. A broken
+    #  processing pool (a worker died) fails the tile-time instead of the whole run.
+    def retry_granule(f, retry, exc):
+        errMessage(f, retry, exc)
+        if retry == 2:
+            for d in file_dict[f]: failed.append(d)
+        else:
+            try:
+                submit_granule(f, retry+1)
+            except Exception as e:
+                retry_granule(f, retry+1, e)
+
+    # Collect the outputs of a processed tile-time (done: how they are reported)
+    def finish_granule(f, result, done='Exported'):
+        nonlocal z
+        # Pass on this dataset if the percent of noData is above the user threshold
+        if result['percentNoData'] is not None:
+            ancIndex = [idx for idx,fileName in enumerate(ancillary_files) if f in fileName][0]
+            del ancillary_files[ancIndex:ancIndex+2]       #Remove the browse and metadata
+            z += len(file_dict[f])+2
+            print('Excluding {} due to {:.1f}% noData in the subset.'.format(f,result['percentNoData']))
+        elif isinstance(roi_shape, dict):
+            z += len(file_dict[f])
+            all_cogs.extend(result['outputs'])  # Update list of outputs
+            print(f"{done} {len(result['outputs'])} subsets of {f} ({z} of {len(files)})")
+        else:
+            for outName in result['outputs']:
+                z += 1
+                all_cogs.append(outName)  # Update list of outputs
+                print(f"{done} {outName} ({z} of {len(files)})")
 
-    # Load into memory using ROI and vsicurl (via rasterio)
+    # Tile-times finished in an earlier run are not accessed again
     for f in file_dict:
-        
-        # Try to access each item/asset 3 times
-        #breakpoint()
-        for retry in range(0,3):
+        result = job.granule(f)
+        if result is None:
             try:
-                # Read Quality band
-                temp_filename = outDir + file_dict[f][0][108:]
-                temp = r.get([file for file in file_dict[f] if 'Fmask' in file][0]).content
-                with open(temp_filename, "wb") as downloaded_file:
-                    downloaded_file.write(temp)
-                qa = rio.open(temp_filename)
-
-                # Convert bbox/geojson from EPSG:4326 to local UTM for scene
-                #breakpoint()
-                utm = pyproj.Proj(qa.crs)                             # Destination CRS read from QA band
-                project = pyproj.Transformer.from_proj(geo_CRS, utm)  # Set up src -> dest transformation
-                roi_UTM = transform(project.transform, roi_shape)     # Apply reprojection to ROI
-                if roi_UTM.has_z:                                     # Remove the third dimension if there is 1
-                    roi_UTM = transform(lambda x, y, z = None: (x, y), roi_UTM)
-
-                # Subset the fmask quality data (returned by default)
-                qa_subset, qa_transform = rio.mask.mask(qa, [roi_UTM], crop=True)
-                
-                #Pass on htis dataset if the percent of noData is below user threshold
-                pixels = qa_subset.shape[1]*qa_subset.shape[2]
-                noData = len(qa_subset[qa_subset==255])
-                percentNoData = (noData/pixels)*100
-                if percentNoData > nd:
-                    ancIndex = [idx for idx,fileName in enumerate(ancillary_files) if f in fileName][0]
-                    del ancillary_files[ancIndex:ancIndex+2]       #Remove the browse and metadata
-                    z += len(file_dict[f])+2
-                    print('Excluding {} due to {:.1f}% noData in the subset.'.format(f,percentNoData))
-                    break
-
-                originalName = qa.name.rsplit('/', 1)[-1] # If only exporting FMASK, use for original name
-                
-                # Loop through and process all other layers (excluding QA)
-                #breakpoint()
-                for b in [file for file in file_dict[f] if 'Fmask' not in file]:
-                    z += 1
-
-                    # Read file and load in subset
-                    #breakpoint()
-                    temp_b = r.get(b).content
-                    temp_b_filename = outDir + b[108:]
-                    with open(temp_b_filename, "wb") as temp_b_file:
-                        temp_b_file.write(temp_b)
-                    band = rio.open(temp_b_filename)
-                    subset, btransform = rio.mask.mask(band, [roi_UTM], crop=True)
-
-                    # Filter by quality if desired
-                    if qf is True:
-                        '''Default Quality filtering here includes: Cloud = No and Cloud Shadow = No'''
-
-                        # List of values meeting quality criteria
-                        goodQ = [0,1,4,5,16,17,20,21,32,33,36,37,48,49,52,53,64,
-                                 65,68,69,80,81,84,85,96,97,100,101,112,113,116,
-                                 117,128,129,132,133,144,145,148,149,160,161,
-                                 164,165,176,177,180,181,192,193,196,197,208,
-                                 209,212,213,224,225,228,229,240,241,244,245]
-
-                        # Apply QA mask and set masked data to fill value
-                        subset = np.ma.MaskedArray(subset, np.in1d(qa_subset, goodQ, invert=True))
-                        subset = np.ma.filled(subset, band.meta['nodata'])
-
-                    # Apply scale factor if desired
-                    if scale is True:
-                        subset = subset[0] * band.scales[0]  # Apply Scale Factor
-
-                        try:
-                            # Reset the fill value
-                            subset[subset == band.meta['nodata'] * band.scales[0]] = band.meta['nodata']
-                        except TypeError:
-                            print(f"Fill Value is not provided for band {band.name.rsplit('.', 2)[-2]}")
+                submit_granule(f, 0)
+            except Exception as e:
+                retry_granule(f, 0, e)
+        else:
+            finish_granule(f, result, 'Already exported')
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, f, retry = pending.pop(future)
+                try:
+                    result = future.result()
+                    # Downloaded: hand the local files over for processing
+                    if stage == 'download':
+                        pending[cpu_pool.submit(process_granule, result, roi_shape, qa_lut, scale, nd, outDir)] = ('process', f, retry)
+                        continue
+                except Exception as e:
+                    retry_granule(f, retry, e)
+                    continue
+
+                job.set_granule(f, result)
+                finish_granule(f, result)
+
+        # Download ancillary files
+        warnings.filterwarnings('ignore')
+        pending = {}
+        for a in ancillary_files:
+            if job.asset(a) is None:
+                pending[io_pool.submit(download_ancillary, a, cache)] = (a, 0)
+            else:
+                z += 1
+                print(f"Already exported {a} ({z} of {len(files)})")
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                a, retry = pending.pop(future)
+                try:
+                    newName = future.result()
+                except Exception as e:
+                    errMessage(a, retry, e)
+                    # Add files that are failing to a list
+                    if retry == 2:
+                        failed.append(a)
                     else:
-                        subset = subset[0]
-                    
-                    ################# EXPORT AS COG ###########################
-                    # Grab the original HLS S30 granule name
-                    originalName = band.name.rsplit('/', 1)[-1]
-                    bandName = band.name.rsplit('.', 2)[-2]
-
-                    # Generate output name from the original filename
-                    outName = f"{outDir}{originalName.split('.v2.0.')[0]}.v2.0.{bandName}.subset.tif"
-                    tempName = f"{outDir}temp.tif"
-
-                    # Create output GeoTIFF with overviews
-                    out_tif = rio.open(tempName, 'w', driver='GTiff', height=subset.shape[0], width=subset.shape[1], count=1, dtype=str(subset.dtype), crs=band.crs, transform=btransform)
-
-                    # Write the scaled, quality filtered band to the newly created GeoTIFF
-                    out_tif.write(subset, 1)
-
-                    # Define number of overviews from the source data
-                    out_tif.build_overviews(band.overviews(1), Resampling.average)  # Calculate overviews
-                    out_tif.update_tags(ns='rio_overview', resampling='average')    # Update tags
-                    out_tif.nodata = band.meta['nodata']                            # Define fill value
-                    kwds = out_tif.profile                                          # Save profile
-                    kwds['tiled'] = True
-                    kwds['compress'] = 'LZW'
-                    out_tif.close()
-
-                    # Open output file, add tiling and compression, and export as valid COG
-                    with rio.open(tempName, 'r+') as src:
-                        rio.shutil.copy(src, outName, copy_src_overviews=True, **kwds)
-                    src.close(), os.remove(tempName)
-
-                    all_cogs.append(outName)  # Update list of outputs
-                    print(f"Exported {outName} ({z} of {len(files)})")
-
-                # Export quality layer (Fmask)
-                outName = f"{outDir}{originalName.split('.v2.0.')[0]}.v2.0.Fmask.subset.tif"
-                tempName = f"{outDir}temp.tif"
-                out_tif = rio.open(tempName, 'w', driver='GTiff', height=qa_subset.shape[1], width=qa_subset.shape[2], count=1, dtype=str(qa_subset.dtype), crs=qa.crs, transform=qa_transform)
-                out_tif.write(qa_subset[0], 1)
-                out_tif.build_overviews(qa.overviews(1), Resampling.average)
-                out_tif.update_tags(ns='rio_overview', resampling='average')
-                out_tif.nodata = qa.meta['nodata']
-                kwds = out_tif.profile
-                kwds['tiled'] = True
-                kwds['compress'] = 'LZW'
-                out_tif.close()
-                with rio.open(tempName, 'r+') as src:
-                    rio.shutil.copy(src, outName, copy_src_overviews=True, **kwds)
-                src.close(), os.remove(tempName)
-                all_cogs.append(outName)
+                        pending[io_pool.submit(download_ancillary, a, cache)] = (a, retry+1)
+                    continue
+                job.set_asset(a, 'downloaded', f"{outDir}{newName}")
                 z += 1
-                print(f"Exported {outName} ({z} of {len(files)})")
-                break
-            except:
-                errMessage(f,retry)
-                # Add files that are failing to a list
-                if retry == 2:
-                    for d in file_dict[f]: failed.append(d)
-                
-    # Download ancillary files
-    warnings.filterwarnings('ignore')
-    for a in ancillary_files:
-        for retry in range(0,3):
-            try:
-                a_content = r.get(a, verify=False).content
-                if a.endswith('.xml'):
-                    newName = a_content[a_content.find(b'<GranuleUR>')+11:a_content.find(b'</GranuleUR>')].decode() + '.metadata.xml'
-                    with open(newName, 'wb') as handler:
-                        handler.write(a_content)
-                    z += 1
-                    print(f"Exported {a} ({z} of {len(files)})")
-                    break
-                else:
-                    with open(a.rsplit('/', 1)[-1], 'wb') as handler:
-                        handler.write(a_content)
-                    z += 1
-                    print(f"Exported {a} ({z} of {len(files)})")
-                    break
-            except:
-                errMessage(f,retry)
-                # Add files that are failing to a list
-                if retry == 2:
-                    failed.append(a)
+                print(f"Exported {a} ({z} of {len(files)})")
+    finally:
+        io_pool.shutdown(cancel_futures=True)
+        cpu_pool.shutdown(cancel_futures=True)
+        job.close()
 
     # If the user asked for COG outputs, end script execution
     if of == 'COG': print(f"All files have been processed and exported to: {outDir}")
     ######################## EXPORT AS NC4 or ZARR ############################
-    # Use xarray to stack the cogs into NC4 or ZARR
+    # Stack the cogs into NC4 or ZARR, one observation at a time
     else:
-        import xarray as xr
-
-        # Split observations by tile (1 nc4/zarr exported per HLS tile)
-        tiles = list(np.unique([c.rsplit('.', 7)[1] for c in all_cogs]))
-        for t in tiles:
-            # If second retry, grab all available files to stack
-            if fileList.endswith('failed.txt'):
-                cogs = [a for a in os.listdir() if t in a and a.endswith('.tif')]
-            else:
-                cogs = [a for a in all_cogs if t in a] 
+        # If second retry, grab all available files to stack
+        if fileList.endswith('failed.txt'):
+            folders = list(roi_shape) if isinstance(roi_shape, dict) else ['']
+            available = [f"{d}{a}" for d in folders for a in os.listdir(d or '.') if a.endswith('.subset.tif')]
+        else:
+            available = all_cogs
 
+        # Split observations by feature folder and tile (1 nc4/zarr exported per HLS tile and feature)
+        groups = {}
+        for c in available:
+            groups.setdefault((os.path.dirname(c), cog_name(c)[0]), []).append(c)
+        for (folder, t), cogs in sorted(groups.items()):
             # Create an output file name using first and last observation date
-            times = list(np.unique([datetime.strptime(c.rsplit('.', 7)[2], '%Y%jT%H%M%S') for c in cogs]))
-            outName = f"HLS.{t}.{min(times).strftime('%m%d%Y')}.{max(times).strftime('%m%d%Y')}.subset"
-
-            # Create a list of variables so script can create xarray data arrays by variable
-            variables = list(np.unique([c.split('.')[-3] for c in cogs]))
-            for j,v in enumerate(variables):
-                vcogs = [vc for vc in cogs if v in vc]
-                for i, c in enumerate(vcogs):
-
-                    # Grab acquisition time from filename
-                    time = datetime.strptime(c.rsplit('.v1.5', 1)[0].rsplit('.', 1)[-1], '%Y%jT%H%M%S')
-
-                    # Need to set up the xarray data array for the first file
-                    if i == 0:
-                        # Open file using rasterio
-                        stack = xr.open_rasterio(c)
-                        stack = stack.squeeze(drop=True)
-
-                        # Define time coordinate
-                        stack.coords['time'] = np.array(time)
-
-                        # Rename coordinates
-                        stack = stack.rename({'x':'lon', 'y':'lat', 'time':'time'})
-                        stack = stack.expand_dims(dim='time')
-
-                        # Below, set up attributes to be CF-Compliant (1.6)
-                        stack.attrs['standard_name'] = v
-                        stack.attrs['long_name'] = f"HLS {v}"
-                        stack.attrs['missing_value'] = stack.nodatavals[0]
-                        stack['x'] = stack.lon
-                        stack['y'] = stack.lat
-                        stack.x.attrs['axis'] = 'X'
-                        stack.x.attrs['standard_name'] = 'projection_x_coordinate'
-                        stack.x.attrs['long_name'] = 'x-coordinate in projected coordinate system'
-                        stack.y.attrs['axis'] = 'Y'
-                        stack.y.attrs['standard_name'] = 'projection_y_coordinate'
-                        stack.y.attrs['long_name'] = 'y-coordinate in projected coordinate system'
-                        stack.time.attrs['axis'] = 'Z'
-                        stack.time['standard_name'] = 'time'
-                        stack.time['long_name'] = 'time'
-                        stack.lon.attrs['units'] = 'degrees_east'
-                        stack.lon.attrs['standard_name'] = 'longitude'
-                        stack.lon.attrs['long_name'] = 'longitude'
-                        stack.lat.attrs['units'] = 'degrees_north'
-                        stack.lat.attrs['standard_name'] = 'latitude'
-                        stack.lat.attrs['long_name'] = 'latitude'
-                        wkt = CRS.from_epsg(stack.crs.split(':')[-1]).to_wkt()
-                        stack['spatial_ref'] = int()
-                        stack.spatial_ref.attrs['grid_mapping_name'] = 'transverse_mercator'
-                        stack.spatial_ref.attrs['spatial_ref'] = wkt
-                        stack.variable.attrs['grid_mapping'] = 'spatial_ref'
-                        stack.variable.attrs['_FillValue'] = stack.nodatavals[0]
-                        stack.variable.attrs['units'] = 'None'
-                        stack.x.attrs['units'] = 'm'
-                        stack.y.attrs['units'] = 'm'
-                        stack.x.attrs['standard_name'] = 'x'
-                        stack.y.attrs['standard_name'] = 'y'
-                        stack.spatial_ref.attrs['standard_name'] = 'CRS'
-                        stack.time.attrs['standard_name'] = 'time'
+            times = [cog_name(c)[1] for c in cogs]
+            outName = os.path.join(folder, f"HLS.{t}.{min(times).strftime('%m%d%Y')}.{max(times).strftime('%m%d%Y')}.subset.{of.lower()}")
 
-                    else:
-                        # If data array already set up, add to it
-                        S = xr.open_rasterio(c)
-                        S = S.squeeze(drop=True)
-                        S.coords['time'] = np.array(time)
-                        S = S.rename({'x':'lon', 'y':'lat', 'time':'time'})
-                        S = S.expand_dims(dim='time')
-
-                        # Concatenate the new array to the data array
-                        stack = xr.concat([stack, S], dim='time')
-                stack.name = v
-
-                # Now merge data arrays into single dataset
-                if j == 0:
-                    stack_dataset = stack
-                else:
-                    stack_dataset = xr.merge([stack_dataset, stack])
-
-            # Make the NetCDF CF-Compliant
-            stack_dataset.attrs['Conventions'] = 'CF-1.6'
-            stack_dataset.attrs['title'] = 'HLS'
-            stack_dataset.attrs['nc.institution'] = 'Unidata'
-            stack_dataset.attrs['source'] = 'LP DAAC'
-        
             # If this is the second run of HLS_PER.py OR there are no failed files, export
             if len(failed) == 0 or fileList.endswith('failed.txt'):
-                
-                # Export as NC4 or ZARR
-                if of == 'NC4':
-                    stack_dataset.to_netcdf(f"{outName}.nc4")
-                    print(f"Exported {outName}.nc4")
-                else:
-                    stack_dataset.to_zarr(f"{outName}.zarr")
-                    print(f"Exported {outName}.zarr")
-        
+                stack_cogs(cogs, outName, of)
+                print(f"Exported {outName}")
+
         # If this is the second run of HLS_PER.py OR there are no failed files, remove cogs
         if len(failed) == 0 or fileList.endswith('failed.txt'): 
         
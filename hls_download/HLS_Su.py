@@ -11,95 +11,111 @@ Last Updated: 03-12-2021
 ===============================================================================
 """
 
+# Collect the links to keep from one CMR-STAC item: browse, metadata and Fmask, then the desired bands/layers.
+#  Returns an empty list if the item is above the cloud cover threshold.
+def item_links(h, bands, cc):
+    links = []
+    
+    # Filter by cloud cover
+    if h['properties']['eo:cloud_cover'] <= cc:
+        try:
+            # Always include browse, metadata, and fmask (QA)
+            links.extend([h['assets']['browse']['href'], h['assets']['metadata']['href'], h['assets']['Fmask']['href']])
+        except:
+            print(f"Browse, metadata, and/or Fmask assets were unavailable for {h}")
+        
+        # Now find the desired bands/layers
+        for l in bands:
+            
+            # Don't duplicate FMASK
+            if l == 'FMASK': continue
+        
+            # Skip a single band (asset) if it does not exist for that item
+            try: 
+                # Add output links to the list
+                links.append(h['assets'][bands[l]]['href']) 
+            except:
+                print(f'{l} band is not available for {h["id"]}') 
+    return links
+
 # Define the script as a function and use the inputs provided by HLS_SuPER.py:
-def hls_subset(bbox_string, outDir, dates, prods, band_dict, cc):
+#  endpoint can point the search at another STAC server (e.g. a local stub for testing).
+#  cache is an optional hls_cache.cache that search responses are read from and saved to.
+#  tiles is an optional {MGRS tile: bbox string} search plan (see find_tiles.plan_searches): one
+#  query per tile and product replaces the single bbox_string query, and only items of that tile are kept.
+def hls_subset(bbox_string, outDir, dates, prods, band_dict, cc, endpoint=None, workers=8, cache=None, tiles=None):
     
     # Load necessary packages into Python
     import os
-    import requests as r
     import sys
+    from stac_search import search_client, lp_stac
 
     # ------------------------------SET-UP WORKSPACE------------------------- #
     # Change the working directory
     os.chdir(outDir)
     
     # CMR-STAC API Endpoint for LP DAAC search 
-    lp_stac = 'https://cmr.earthdata.nasa.gov/stac/LPCLOUD/search?'   
+    if endpoint is None:
+        endpoint = lp_stac
     
     # ------------------------------PERFORM SEARCH QUERY--------------------- #
     bandLinks = [] # Create an empty list to save the output URLs
     num_tiles = 0
+    seen = set()   # Item IDs already processed
+    found = set()  # Products with at least one matching item
+
+    # Set up one search query per product; all products and their pages are requested concurrently
+    if tiles is None:
+        queries = [{"bbox": bbox_string, "datetime": dates, "collections": [prods[b]]} for b in band_dict]
+        query_tiles = {}
+    else:
+        queries, query_tiles = [], {}
+        for t in tiles:
+            for b in band_dict:
+                queries.append({"bbox": tiles[t], "datetime": dates, "collections": [prods[b]]})
+                query_tiles[id(queries[-1])] = t
+    products = {prods[b]: b for b in band_dict}
 
-    for b in band_dict:        
-        page = 1
-        # Attempt to access STAC up to 3 times
-        for retry in range(0,3):
+    # Save the links in a text file as they arrive
+    out_file = f"{outDir}HLS_SuPER_links.txt"
+    with search_client(endpoint, workers=workers, cache=cache) as client, open(out_file, "w") as output:
+        for q, h in client.items(queries):
+            b = products[q['collections'][0]]
+
+            # A tile's bbox also matches the neighbouring tiles that overlap it
+            if id(q) in query_tiles and h['id'].split('.')[2].lstrip('T') != query_tiles[id(q)].lstrip('T'): continue
+            
+            # Pages requested concurrently can overlap if the catalog changes during the search
+            if h['id'] in seen: continue
+            seen.add(h['id'])
+            if b not in found:
+                print(f'There are matching outputs found for {b}')
+                found.add(b)
             
-            # Set up a search query dictionary with all the desired query parameters
-            params = {"bbox": bbox_string, "limit": 100, "datetime": dates, "collections": [prods[b]], "page": page}
-            #search_query = f"{lp_stac}&collections={prods[b]}&bbox={bbox_string}&datetime={dates}&limit={limit}&page={page}"
-            # Post params dict to the CMR-STAC search endpoint
-            if r.post(lp_stac, json=params).status_code == 200:        # Check status code for successful query or not
-                search_response = r.post(lp_stac, json=params).json()  # Send GET request to retrieve items
-                if len(search_response['features']) == 0:     # Raise warning to users that no intersecting files were found
-                    print(f'There were no matching outputs found for {b} (Attempt: {retry + 1} of 3)')
-                    continue
-                else:
-                    print(f'There are matching outputs found for {b}')
-                    while search_response['numberReturned'] != 0:
-                        # Iterate through each item and find the desired assets (layers)
-                        for h in search_response['features']:
-                            
-                            # Filter by cloud cover
-                            if h['properties']['eo:cloud_cover'] <= cc:
-                                try:
-                                    # Always include browse, metadata, and fmask (QA)
-                                    bandLinks.append(h['assets']['browse']['href']) 
-                                    bandLinks.append(h['assets']['metadata']['href'])
-                                    bandLinks.append(h['assets']['Fmask']['href'])
-                                    num_tiles += 1
-                                except:
-                                    print(f"Browse, metadata, and/or Fmask assets were unavailable for {h}")
-                                
-                                # Now find the desired bands/layers
-                                for l in band_dict[b]:
-                                    
-                                    # Don't duplicate FMASK
-                                    if l == 'FMASK': continue
-                                
-                                    # Skip a single band (asset) if it does not exist for that item
-                                    try: 
-                                        # Add output links to the list
-                                        bandLinks.append(h['assets'][band_dict[b][l]]['href']) 
-                                    except:
-                                        print(f'{b} band is not available for {h["id"]}') 
-                        
-                        # Move to the next page until all granules are found
-                        page += 1
-                        params['page'] = page
-                        search_response = r.post(lp_stac, json=params).json()  # Send GET request to retrieve items
-                    break
-            # Attempt to find the source of an unsuccessful query 
-            else:                                                      
-                if r.post(lp_stac).status_code != 200: 
-                    print(f"ERROR: The CMR-STAC Service is either down or you may not be connected to the internet. (Attempt {retry+1} of 3)")
-                elif r.post(lp_stac, json={"bbox": bbox_string, "limit": 100, "collections": [prods[b]]}).status_code != 200:
-                    print(f"ERROR: The ROI was rejected by the server. (Attempt {retry+1} of 3)")
-                else:
-                    print(f"ERROR: The start and/or end dates were rejected by the server. (Attempt {retry+1} of 3)") 
+            # Iterate through each item and find the desired assets (layers)
+            links = item_links(h, band_dict[b], cc)
+            if links:
+                num_tiles += 1
+                for link in links:
+                    output.write(f'{link}\n')
+                bandLinks.extend(links)
+
+        # Report requests that still failed after retrying
+        for q, page, e in client.errors:
+            print(f"ERROR: The CMR-STAC search for {products[q['collections'][0]]} failed on page {page}: {e}")
+    
+    for b in band_dict:
+        if b not in found:
+            print(f'There were no matching outputs found for {b}')
 
     print(f"\n{num_tiles} granules intersect with your query including {len(bandLinks)} downloadable files.")
     
     # Exit script if no intersecting files found
     if num_tiles == 0:
+        os.remove(out_file)
         sys.exit()
         
     print("Links to those files are saved in the file below:")    
-    # Save the links in a text file 
-    out_file = f"{outDir}HLS_SuPER_links.txt"
-    with open(out_file, "w") as output:
-        for link in bandLinks:
-            output.write(f'{link}\n')
     print(out_file)
         
     # Ask user if they would like to continue with processing or exit
@@ -27,6 +27,9 @@ parser.add_argument('-roi', type=str, nargs='*', required=True, help="(Required)
                     NOTE: Negative coordinates MUST be written in single quotation marks '-120,43,-118,48'\
                     NOTE 2: If providing an absolute path with spaces in directory names, please use double quotation marks "" ")
 
+# features: process only the first feature of a multi-feature ROI file, or all of them
+parser.add_argument('-features' ,choices = ['first', 'all'], required=False, help='Features of a multi-feature geojson/shapefile/kml ROI to process: only the first one, or all of them. With all, the features are resolved to their MGRS tiles, each tile is searched once, and every feature is clipped from the shared downloads into its own feature_<n> subfolder.', default='first')
+
 # dir: Directory to save the files to
 parser.add_argument('-dir', required=False, help='Directory to export output HLS files to.', default=os.getcwd())
 
@@ -51,12 +54,27 @@ parser.add_argument('-nd', required=False, help='Maximum (scene-level) cloud cov
 # qf: quality filter flag: filter out poor quality data yes/no
 parser.add_argument('-qf' ,choices = ['True', 'False'], required=False, help='Flag to quality filter before exporting output files (see README for quality filtering performed).', default='True')
 
+# qfilter: Fmask conditions removed by the quality filter
+parser.add_argument('-qfilter', required=False, help='Fmask conditions to filter out when -qf is True. Valid inputs are CIRRUS, CLOUD, ADJACENT, SHADOW, SNOW, WATER, AEROSOL-LOW, AEROSOL-MODERATE, AEROSOL-HIGH (an aerosol level also removes the levels above it). To request multiple conditions, provide them in comma separated format with no spaces.', default='CLOUD,SHADOW')
+
 # sf: scale factor flag: Scale data or leave unscaled yes/no
 parser.add_argument('-scale' ,choices = ['True', 'False'], required=False, help='Flag to apply scale factor to layers before exporting output files.', default='True')
 
 # of: output file format
 parser.add_argument('-of' ,choices = ['COG', 'NC4', 'ZARR'], required=False, help='Define the desired output file format', default='COG')
 
+# workers: number of granules downloaded and processed at the same time
+parser.add_argument('-workers', required=False, help='Number of granules to download and process concurrently (e.g. 8). Valid range: 1 or greater (integers only)', default='4')
+
+# access: download whole files, or read only the ROI window of each remote COG
+parser.add_argument('-access' ,choices = ['download', 'window'], required=False, help='How to access the source COGs: download each file in full, or read only the window intersecting the ROI over HTTP range requests (nothing is downloaded to disk).', default='download')
+
+# cache: directory for a persistent cache of search responses and downloaded files
+parser.add_argument('-cache', required=False, help='Directory to keep a persistent cache of CMR-STAC search responses and downloaded files in, so identical searches and files that were already downloaded are served from disk. Caching is off unless a directory is given.', default=None)
+
+# cache_size: maximum size of the cache
+parser.add_argument('-cache_size', required=False, help='Maximum size of the cache in GB (e.g. 50). Least recently used files are removed once it is full.', default='20')
+
 args = parser.parse_args()
 
 ######################### Handle Inputs #######################################
@@ -86,7 +104,7 @@ if ROI.endswith(('json', 'shp', 'kml')):
             bbox.to_crs("EPSG:4326", inplace=True)
             print("Note: ROI submitted is being converted to Geographic CRS (EPSG:4326)")
         # Check for number of features included in ROI
-        if len(bbox) > 1:                                                            
+        if len(bbox) > 1 and args.features == 'first':                                                            
             print('Multi-feature polygon detected. Only the first feature will be used.')
             bbox = bbox[0:1]
     except:
@@ -94,8 +112,8 @@ if ROI.endswith(('json', 'shp', 'kml')):
     
     
     # Verify the geometry is valid and convert to comma separated string
-    if  bbox['geometry'][0].is_valid:
-        bounding_box = [b for b in bbox['geometry'][0].bounds]
+    if  bbox['geometry'].is_valid.all():
+        bounding_box = [b for b in bbox.total_bounds]
         bbox_string = ''
         for b in bounding_box: bbox_string += f"{b},"
         bbox_string = bbox_string[:-1]
@@ -238,6 +256,13 @@ qf = args.qf
 if qf == 'True': qf = True
 else: qf = False
 
+# Strip spacing, quotes, make all upper case and create a list
+qa_filters = args.qfilter.strip(' ').strip("'").strip('"').upper().split(',')
+all_filters = ['CIRRUS', 'CLOUD', 'ADJACENT', 'SHADOW', 'SNOW', 'WATER', 'AEROSOL-LOW', 'AEROSOL-MODERATE', 'AEROSOL-HIGH']
+for q in qa_filters:
+    if q not in all_filters:
+        sys.exit(f"Quality filter: {q} is not a valid input option. Valid inputs are {', '.join(all_filters)}. To request multiple conditions, provide them in comma separated format with no spaces.")
+
 # SCALE FACTOR ----------------------------------------------------------------
 scale = args.scale
 
@@ -248,6 +273,40 @@ else: scale = False
 #  OUTPUT FORMAT --------------------------------------------------------------
 of = args.of
 
+# WORKERS ---------------------------------------------------------------------
+# Make sure workers is a valid integer
+try:
+    workers = int(args.workers.strip("'").strip('"'))
+except: 
+    sys.exit(f"{args.workers} is not a valid input for the number of workers (e.g. 8). Valid range: 1 or greater (integers only)")
+
+if workers < 1:
+    sys.exit(f"{args.workers} is not a valid input for the number of workers (e.g. 8). Valid range: 1 or greater (integers only)")
+
+# ACCESS MODE -----------------------------------------------------------------
+access = args.access
+
+# CACHE -----------------------------------------------------------------------
+# Make sure cache_size is a valid number
+try:
+    cache_size = float(args.cache_size.strip("'").strip('"'))
+except: 
+    sys.exit(f"{args.cache_size} is not a valid input for the cache size in GB (e.g. 50).")
+
+if args.cache is not None:
+    cacheDir = os.path.normpath(args.cache.strip("'").strip('"'))
+
+# SEARCH PLAN -----------------------------------------------------------------
+# Search every MGRS tile of a multi-feature ROI once, with a bbox that only covers its features
+tiles = None
+if args.features == 'all' and isinstance(bbox, gp.GeoDataFrame) and len(bbox) > 1:
+    import find_tiles
+    if os.path.exists(find_tiles.s2_grid_file):
+        tiles = find_tiles.plan_searches(bbox)
+        print(f"The {len(bbox)} features of the ROI are covered by {len(tiles)} MGRS tile(s), each searched once.")
+    else:
+        print(f"Note: the MGRS grid ({find_tiles.s2_grid_file}) was not found, searching the bounds of all features at once.")
+
 # FILE LIST -------------------------------------------------------------------
 fileList = f"{outDir}HLS_SuPER_links.txt"
 
@@ -257,8 +316,15 @@ os.chdir(sys.path[0])  # Switch back to the script directory to execute
 # Call HLS_Su.py using inputs provided
 from HLS_Su import hls_subset
 
+# Set up the search/download cache if requested
+if args.cache is not None:
+    from hls_cache import cache
+    hls_cache = cache(cacheDir, max_size=cache_size*1e9)
+else:
+    hls_cache = None
+
 # Query CMR-STAC
-dl = hls_subset(bbox_string, outDir, dates, prods, band_dict, cc)  
+dl = hls_subset(bbox_string, outDir, dates, prods, band_dict, cc, cache=hls_cache, tiles=tiles)  
 
 #################### PROCESS AND EXPORT REFORMATTED ###########################
 # If user decides to continue downloading the intersecting files:
@@ -267,7 +333,7 @@ if dl[0].lower() == 'y':
     
     # Call HLS_PER.py using inputs provided and output text file from HLS_Su.py
     from HLS_PER import hls_process
-    hls_process(outDir, ROI, qf, scale, of, nd, fileList)  # Access Data, Scale/QF, Export
+    hls_process(outDir, ROI, qf, scale, of, nd, fileList, workers, access, hls_cache, qa_filters, args.features)  # Access Data, Scale/QF, Export
 
 #################### PROCESS AND EXPORT REFORMATTED (2) #######################
 # If any of the downloads failed, retry processing one more time
@@ -278,7 +344,7 @@ if os.path.exists(fileList):
     
     # Call HLS_PER.py using inputs provided and output text file from HLS_Su.py
     from HLS_PER import hls_process
-    hls_process(outDir, ROI, qf, scale, of, nd, fileList)  # Access Data, Scale/QF, Export
+    hls_process(outDir, ROI, qf, scale, of, nd, fileList, workers, access, hls_cache, qa_filters, args.features)  # Access Data, Scale/QF, Export
 
 ###############################################################################
 # Delete the failed downloads if exist (the ones that ended up DLing successfully)
\ No newline at end of file
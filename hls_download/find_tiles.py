@@ -1,9 +1,13 @@
 #find_tile.py
 
 import os
+import sys
+import warnings
+import importlib.util
 import geopandas as gp
 
-def open_ROI_file(file):
+#all_features=True keeps every feature of the file (see plan_tiles) instead of only the first.
+def open_ROI_file(file, all_features=False):
     #breakpoint()
     if file.endswith(('json', 'shp', 'kml')): 
         # Read file in and grab bounds
@@ -20,7 +24,7 @@ def open_ROI_file(file):
                 bbox.to_crs("EPSG:4326", inplace=True)
                 print("Note: ROI submitted is being converted to Geographic CRS (EPSG:4326)")
             # Check for number of features included in file
-            if len(bbox) > 1:                                                            
+            if len(bbox) > 1 and not all_features:                                                            
                 print('Multi-feature polygon detected. Only the first feature will be used.')
                 bbox = bbox[0:1]
             
@@ -43,45 +47,133 @@ def get_bbox_string(bbox):
 
 
 
+# The Sentinel-2 (MGRS) grid, loaded once per process by load_grid (grid file: GeoDataFrame)
+s2_grids = {}
+s2_grid_file = os.path.join(os.path.dirname(__file__),'data','s2_grid.json')
+
+# Load the global MGRS grid. The GeoJSON is slow to parse, so the first load also saves a binary
+#  copy next to it (GeoParquet if pyarrow is installed, FlatGeobuf otherwise) that later runs read
+#  instead, until the GeoJSON is newer. The grid's spatial index (an STRtree) is built here as well,
+#  so every find_MGRS_tiles call after the first only queries it.
+def load_grid(grid_file=s2_grid_file):
+    if grid_file in s2_grids:
+        return s2_grids[grid_file]
+
+    if importlib.util.find_spec('pyarrow') is not None:
+        binary_file, read, write = grid_file.rsplit('.', 1)[0] + '.parquet', gp.read_parquet, gp.GeoDataFrame.to_parquet
+    else:
+        binary_file, read, write = grid_file.rsplit('.', 1)[0] + '.fgb', gp.read_file, lambda grid, file: grid.to_file(file, driver='FlatGeobuf')
+
+    if os.path.exists(binary_file) and os.path.getmtime(binary_file) >= os.path.getmtime(grid_file):
+        grid = read(binary_file)
+    else:
+        grid = gp.GeoDataFrame.from_file(grid_file)
+        try:
+            write(grid, binary_file)
+        except Exception as e:  # Read-only install (the OGR drivers raise their own errors): keep using the GeoJSON
+            warnings.warn(f"Could not save a binary copy of the MGRS grid to {binary_file} ({e}); reading the GeoJSON instead.")
+            if os.path.exists(binary_file):
+                try:
+                    os.remove(binary_file)  # Don't read a partial copy on the next run
+                except OSError:
+                    pass
+
+    grid.sindex  # Build the spatial index now, once
+    s2_grids[grid_file] = grid
+    return grid
+
+#Percent of each whole (feature) covered by its part. Areas are in the grid's geographic CRS; only
+#  their ratio is used, so geopandas' warning about geographic areas doesn't apply.
+def percent_covered(parts, wholes):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        return parts.area/wholes.area*100
+
 #
 def find_MGRS_tiles(ROI,print_summary=True):
-    
-    s2_grid_file = os.path.join(os.path.dirname(__file__),'data','s2_grid.json')
-    s2_grid = gp.GeoDataFrame.from_file(s2_grid_file)
 
-    ROI_geom = ROI.to_crs(s2_grid.crs)['geometry'][0]
+    s2_grid = load_grid()
+
+    ROI_geom = ROI.to_crs(s2_grid.crs)['geometry'].iloc[0]
 
-    intersecting_tiles = s2_grid.intersects(ROI_geom)
-    tiles_containing = intersecting_tiles[intersecting_tiles==True].index.values.tolist()
+    # Candidate tiles from the spatial index, then exact overlap for those only
+    tiles_containing = sorted(s2_grid.sindex.query(ROI_geom, predicate='intersects'))
 
     if tiles_containing:
-        tiles = []
-        coverage = []
-        for ind,tile in s2_grid.iloc[tiles_containing].iterrows():
-            tiles.append(tile['identifier'])
-            area_overlapped = ROI_geom.intersection(tile['geometry']).area
-            coverage.append((area_overlapped/ROI_geom.area)*100)
-        
+        candidates = s2_grid.iloc[tiles_containing]
+        tiles = candidates['identifier'].tolist()
+        coverage = percent_covered(candidates.geometry.values.intersection(ROI_geom), ROI_geom).tolist()
+
         if print_summary:
             print('Input geometry contained in {} HLS tile(s):'.format(len(tiles)))
             for ind,tile in enumerate(tiles):
                 print('  {} covers {:.1f}%'.format(tile,coverage[ind]))
-        
+
         #
         tiles = filter_results(tiles, coverage)
         return tiles
-        
+
     else:
         print('No overlap found with any MGRS tiles')
         return None
 
+# Resolve every feature of a GeoDataFrame to its MGRS tiles with one spatial join against the grid.
+#  Returns a DataFrame with one row per (feature, tile): the feature's position in ROI, the tile
+#  identifier, and the percent of the feature the tile covers. As in filter_results, a feature that
+#  fits entirely in a tile only keeps that tile (the same one find_MGRS_tiles would pick).
+def plan_tiles(ROI):
+    import pandas as pd
+
+    s2_grid = load_grid()
+    features = ROI.to_crs(s2_grid.crs).reset_index(drop=True)
+
+    pairs = gp.sjoin(features[['geometry']], s2_grid[['identifier', 'geometry']], predicate='intersects')
+    feature_geoms = features.geometry.values[pairs.index.values]
+    tile_geoms = s2_grid.geometry.values[pairs['index_right'].values]
+    coverage = percent_covered(feature_geoms.intersection(tile_geoms), feature_geoms)
+    plan = pd.DataFrame({'feature': pairs.index.values, 'grid_index': pairs['index_right'].values,
+                         'tile': pairs['identifier'].values, 'coverage': coverage})
+    plan = plan.sort_values(['feature', 'grid_index']).drop(columns='grid_index').reset_index(drop=True)
+
+    full = plan[plan['coverage'] == 100.0].drop_duplicates('feature')
+    return pd.concat([plan[~plan['feature'].isin(full['feature'])], full]).sort_index()
+
+# Plan one CMR-STAC search per unique tile for every feature of a GeoDataFrame, instead of one
+#  search per feature. Returns {tile: bbox string}; each bbox covers the tile's features clipped
+#  to the tile, so the searches stay small. Matching items still need filtering to their tile
+#  (see HLS_Su.hls_subset), since a bbox near a tile edge also matches its overlapping neighbours.
+def plan_searches(ROI):
+    s2_grid = load_grid()
+    features = ROI.to_crs(s2_grid.crs).reset_index(drop=True)
+    plan = plan_tiles(ROI)
+    tile_geoms = s2_grid.set_index('identifier').geometry
+
+    searches = {}
+    for tile, group in plan.groupby('tile'):
+        area = features.geometry.iloc[group['feature'].values].unary_union.intersection(tile_geoms[tile])
+        bounds = gp.GeoSeries([area], crs=s2_grid.crs).to_crs('EPSG:4326').total_bounds
+        searches[tile] = ','.join(f"{b}" for b in bounds)
+    return searches
+
+# Bbox strings of MGRS tiles' footprints, to search for tiles by ID: {tile: bbox string}.
+#  Tile IDs can be given with or without the leading 'T' of HLS granule names (T10SEG or 10SEG).
+def tile_bboxes(tileIDs):
+    s2_grid = load_grid().set_index('identifier')
+
+    tiles = list(dict.fromkeys(str(t).upper().lstrip('T') for t in tileIDs))
+    unknown = [t for t in tiles if t not in s2_grid.index]
+    if unknown:
+        sys.exit(f"Tile(s) {', '.join(unknown)} are not valid MGRS tile IDs (e.g. 10SEG).")
+
+    footprints = gp.GeoSeries(s2_grid.geometry.loc[tiles].values, crs=s2_grid.crs).to_crs('EPSG:4326')
+    return {t: ','.join(f"{b}" for b in geom.bounds) for t, geom in zip(tiles, footprints)}
+
 #Sort poor and repetitive results from the output of 
 def filter_results(tiles,coverage):
     
     #If there's only 1 result, just return that
     if len(tiles) == 1:
         return tiles
-    breakpoint()
     #If the AOI fits entirely in at least 1 tile, remove all partial fits
     #  If the AOI is entirely within multiple tiles, arbitrarily pick 1, additional tiles will have the same data
     if 100.0 in coverage:
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+HLS Local Cache
+A persistent, size-bounded cache for CMR-STAC search responses and downloaded
+HLS assets. Entries are stored under the SHA-256 hash of their key (the search
+query or the asset URL), so a repeated search or download of the same asset is
+answered from disk instead of the network.
+-------------------------------------------------------------------------------
+- Eviction is least-recently-used: every hit stamps the entry's access time,
+  and once the cache grows past max_size the least recently used entries are
+  removed until it fits again.
+- Expiry is by age since the entry was written (its modification time).
+  Search responses expire after search_ttl seconds since new granules are
+  ingested daily; assets are immutable versioned granules and only expire
+  after asset_ttl seconds (None = never).
+- Writes go to a temp file that is renamed into place, so concurrent workers
+  never see a partial entry. Assets are downloaded to a .part file of their
+  own, so an interrupted download is resumed by the next fetch; .part files
+  left untouched for part_ttl seconds are removed.
+===============================================================================
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import tempfile
+
+class cache(object):
+    def __init__(self, path='~/.hls_cache', max_size=20e9, search_ttl=86400, asset_ttl=None, part_ttl=7*86400):
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+        self.search_ttl = search_ttl
+        self.asset_ttl = asset_ttl
+        self.part_ttl = part_ttl
+        self._lock = threading.Lock()
+        self._fetching = {}  # Asset path: lock held while a thread downloads it
+        os.makedirs(self.path, exist_ok=True)
+        self.remove_parts()
+        self.size = sum(os.path.getsize(f) for f in self.entries())
+
+    #Hash a key (URL string or JSON-serializable query) into a cache file path.
+    def entry(self, kind, key):
+        if not isinstance(key, str):
+            key = json.dumps(key, sort_keys=True)
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.path, kind, digest[:2], digest)
+
+    #All cache files currently on disk (parts=True: the .part files of unfinished writes instead).
+    def entries(self, parts=False):
+        for root, dirs, files in os.walk(self.path):
+            for file in files:
+                if file.endswith('.part') == parts:
+                    yield os.path.join(root, file)
+
+    #Remove the .part files of downloads and writes that were abandoned (untouched for part_ttl seconds).
+    def remove_parts(self):
+        now = time.time()
+        for f in self.entries(parts=True):
+            try:
+                if now - os.path.getmtime(f) > self.part_ttl:
+                    os.remove(f)
+            except FileNotFoundError:
+                pass
+
+    #Return the path of a live entry and mark it as recently used, or None on a miss.
+    #  An entry evicted by another thread in the meantime is a miss too.
+    def lookup(self, path, ttl):
+        try:
+            stat = os.stat(path)
+            now = time.time()
+            if ttl is not None and now - stat.st_mtime > ttl:
+                self.remove(path)
+                return None
+            os.utime(path, (now, stat.st_mtime))  # atime = last use, mtime = written
+        except FileNotFoundError:
+            return None
+        return path
+
+    #Move a finished temp file into the cache (temp=None: already written to path) and evict if the
+    #  cache is now too large.
+    def store(self, temp, path):
+        if temp is not None:
+            os.replace(temp, path)
+        with self._lock:
+            try:
+                self.size += os.path.getsize(path)
+            except FileNotFoundError:
+                pass  # Already evicted by another thread
+        if self.size > self.max_size:
+            self.evict()
+        return path
+
+    def remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self.size -= size
+
+    #Drop abandoned .part files, then least recently used entries until the cache is back under max_size.
+    def evict(self):
+        self.remove_parts()
+        with self._lock:
+            stats = []
+            for f in self.entries():
+                try:
+                    stats.append((os.stat(f), f))
+                except FileNotFoundError:
+                    pass
+            stats.sort(key=lambda s: s[0].st_atime)
+            self.size = sum(stat.st_size for stat, f in stats)
+            for stat, f in stats:
+                if self.size <= self.max_size:
+                    break
+                try:
+                    os.remove(f)
+                    self.size -= stat.st_size
+                except FileNotFoundError:
+                    pass
+
+    def temp(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        os.close(handle)
+        return temp
+
+    '''#########################################################################
+    ## Search responses
+    #########################################################################'''
+
+    #Cached response for a search (endpoint + query parameters), or None.
+    def get_search(self, query):
+        path = self.lookup(self.entry('search', query), self.search_ttl)
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None  # Evicted since the lookup
+
+    def put_search(self, query, response):
+        path = self.entry('search', query)
+        temp = self.temp(path)
+        with open(temp, 'w') as f:
+            json.dump(response, f)
+        self.store(temp, path)
+
+    '''#########################################################################
+    ## Assets
+    #########################################################################'''
+
+    #Path of the cached copy of an asset URL, or None.
+    def get_asset(self, url):
+        return self.lookup(self.entry('assets', url), self.asset_ttl)
+
+    #Cache an asset, pulling it with download(url, file_path) on a miss. Returns the cached path.
+    #  download must only create file_path once the file is complete, writing to file_path + '.part'
+    #  until then, and continue that .part file if it exists (HLS_PER.download_file with resume=True).
+    #  Threads asking for the same asset wait for the one already downloading it.
+    def fetch_asset(self, url, download):
+        path = self.get_asset(url)
+        if path is None:
+            path = self.entry('assets', url)
+            with self._lock:
+                fetching = self._fetching.setdefault(path, threading.Lock())
+            with fetching:
+                if self.get_asset(url) is None:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    download(url, path)
+                    self.store(None, path)
+        return path
+
+    #Place a cached asset at dest, as a hard link when possible so it doesn't take up space twice.
+    def link_asset(self, url, dest, download):
+        if os.path.exists(dest):
+            os.remove(dest)
+        for attempt in range(2):
+            path = self.fetch_asset(url, download)
+            if not os.path.exists(path) and attempt == 0:
+                continue  # Evicted right after it was fetched: fetch it again
+            try:
+                os.link(path, dest)
+            except OSError:
+                shutil.copyfile(path, dest)
+            return dest
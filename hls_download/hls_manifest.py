@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+HLS Job Manifest
+A persistent record (SQLite) of an HLS_PER.py run, so an interrupted run
+resumes from where it stopped instead of starting over.
+-------------------------------------------------------------------------------
+- Every asset (source band, Fmask, browse and metadata file) is recorded with
+  its state, byte size, modification time, SHA-256 checksum and local path.
+  A downloaded asset is reused on the next run as long as its file is still
+  there with the same size and modification time. Only a file whose time
+  changed (or every file, with verify=True) is hashed again, and reused if its
+  checksum still matches. A partial download is continued from its .part
+  file (see HLS_PER.download_file).
+- Every granule (tile-time) is recorded once it is processed, with its output
+  files, or with its percent of noData if it was excluded. It is skipped on
+  the next run as long as all of its outputs still exist.
+- Processing results only hold for the same ROI and options. The manifest
+  keeps a signature of those (including the ROI geometry itself, not only its
+  file name), and forgets the processed granules (but not the downloaded
+  assets) when a run with different ones is started in the same directory.
+- Everything is also kept in memory, so lookups don't touch the database.
+  Updates are written through immediately, from any thread.
+===============================================================================
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+
+#SHA-256 checksum of a local file.
+def file_sha256(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+class manifest(object):
+    def __init__(self, path, signature=None, verify=False):
+        self.path = path
+        self.verify = verify
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)  # Autocommit
+        self.db.executescript('''CREATE TABLE IF NOT EXISTS job (signature TEXT);
+                                 CREATE TABLE IF NOT EXISTS assets (url TEXT PRIMARY KEY, state TEXT, size INTEGER, sha256 TEXT, path TEXT, mtime REAL);
+                                 CREATE TABLE IF NOT EXISTS granules (granule TEXT PRIMARY KEY, state TEXT, percent_nodata REAL, outputs TEXT);''')
+
+        # Manifests from before modification times were recorded
+        if 'mtime' not in [row[1] for row in self.db.execute('PRAGMA table_info(assets)')]:
+            self.db.execute('ALTER TABLE assets ADD COLUMN mtime REAL')
+
+        # Processed granules from a run with another ROI or other options don't apply to this one
+        signature = json.dumps(signature, sort_keys=True, default=str)
+        previous = self.db.execute('SELECT signature FROM job').fetchone()
+        if previous is None or previous[0] != signature:
+            self.db.executescript('DELETE FROM job; DELETE FROM granules;')
+            self.db.execute('INSERT INTO job VALUES (?)', (signature,))
+
+        self.assets = {row[0]: row[1:] for row in self.db.execute('SELECT url, state, size, sha256, path, mtime FROM assets')}
+        self.granules = {row[0]: row[1:] for row in self.db.execute('SELECT * FROM granules')}
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    '''#########################################################################
+    ## Assets
+    #########################################################################'''
+
+    #Local path of an asset finished in an earlier run, or None if it needs to be (re)downloaded.
+    #  A file with the recorded size and modification time is trusted without reading it.
+    def asset(self, url):
+        state, size, sha256, path, mtime = self.assets.get(url, (None,)*5)
+        if state != 'downloaded':
+            return None
+        try:
+            stat = os.stat(path)
+            if stat.st_size != size:
+                return None
+            if self.verify or stat.st_mtime != mtime:
+                if file_sha256(path) != sha256:
+                    return None
+                self.set_asset(url, state, path, sha256)  # Still the same file: record its new time
+        except OSError:
+            return None
+        return path
+
+    #Record an asset's state. A downloaded asset's size and time (and checksum, unless given) are taken from its file.
+    def set_asset(self, url, state, path, sha256=None):
+        size = mtime = None
+        if state == 'downloaded':
+            stat = os.stat(path)
+            size, mtime = stat.st_size, stat.st_mtime
+            if sha256 is None:
+                sha256 = file_sha256(path)
+        with self._lock:
+            self.assets[url] = (state, size, sha256, path, mtime)
+            self.db.execute('INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?, ?)', (url, state, size, sha256, path, mtime))
+
+    '''#########################################################################
+    ## Granules
+    #########################################################################'''
+
+    #Result of a granule processed in an earlier run ({'outputs', 'percentNoData'} as returned by
+    #  HLS_PER.process_granule), or None if it needs to be processed.
+    def granule(self, key):
+        state, percent, outputs = self.granules.get(key, (None, None, None))
+        if state is None:
+            return None
+        outputs = json.loads(outputs)
+        if not all(os.path.exists(o) for o in outputs):
+            return None
+        return {'outputs': outputs, 'percentNoData': percent}
+
+    #Record the result of processing a granule.
+    def set_granule(self, key, result):
+        state = 'excluded' if result['percentNoData'] is not None else 'done'
+        row = (state, result['percentNoData'], json.dumps(result['outputs']))
+        with self._lock:
+            self.granules[key] = row
+            self.db.execute('INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?)', (key,) + row)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+CMR-STAC Search Client
+A reusable client for paginated CMR-STAC searches. One pooled HTTP session is
+shared by every request, products (or any other set of queries) and their
+result pages are fetched concurrently in a thread pool, failed requests are
+retried with exponential backoff, and matching items are streamed back as
+soon as each page arrives.
+-------------------------------------------------------------------------------
+Usage:
+    with search_client() as client:
+        for query, item in client.items([{'collections': ['HLSS30.v2.0'], 'bbox': bbox_string, 'datetime': dates}]):
+            ...
+The endpoint can point at any STAC /search URL, e.g. a local stub server, and
+pages can be served from an hls_cache.cache.
+===============================================================================
+"""
+
+import math
+import requests as r
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# CMR-STAC API Endpoint for LP DAAC search
+lp_stac = 'https://cmr.earthdata.nasa.gov/stac/LPCLOUD/search'
+
+class search_client(object):
+    #cache: an optional hls_cache.cache; pages already in it are served without a request.
+    def __init__(self, endpoint=lp_stac, limit=100, workers=8, retries=5, backoff=1.0, timeout=120, cache=None):
+        self.endpoint = endpoint
+        self.limit = limit
+        self.timeout = timeout
+        self.cache = cache
+
+        # Retry connection errors, throttling and server errors with exponential backoff
+        #  (backoff, 2*backoff, 4*backoff... seconds). POST is retried too, since searches are read-only.
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset(['GET', 'POST']), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+        self.session = r.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.errors = []  # (query, page, exception) for requests that still failed after retrying
+
+    #POST one page of a query and return the decoded response. Raises on HTTP errors.
+    def page(self, query, page=1):
+        params = dict(query, limit=self.limit, page=page)
+        if self.cache is not None:
+            key = {'endpoint': self.endpoint, 'params': params}
+            cached = self.cache.get_search(key)
+            if cached is not None:
+                return cached
+        response = self.session.post(self.endpoint, json=params, timeout=self.timeout)
+        response.raise_for_status()
+        response = response.json()
+        if self.cache is not None:
+            self.cache.put_search(key, response)
+        return response
+
+    #Total number of pages for a query, from the first page. None if the server doesn't say.
+    def num_pages(self, response):
+        matched = response.get('numberMatched', response.get('context', {}).get('matched'))
+        if matched is None:
+            return None
+        return math.ceil(matched/self.limit)
+
+    #Run every query concurrently and yield (query, item) pairs as pages arrive.
+    #  The first page of every query is requested at once. When it tells us how many items
+    #  matched, all remaining pages are requested together; otherwise pages are followed
+    #  one after another until an empty page is returned. Pages that fail after all retries
+    #  are skipped and recorded in self.errors.
+    def items(self, queries):
+        pending = {self.pool.submit(self.page, q, 1): (q, 1, False) for q in queries}
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    q, page, follow = pending.pop(future)
+                    try:
+                        response = future.result()
+                    except (r.exceptions.RequestException, ValueError) as e:
+                        self.errors.append((q, page, e))
+                        continue
+                    features = response.get('features', [])
+                    if page == 1:
+                        pages = self.num_pages(response)
+                        if pages is None:
+                            follow = True
+                        else:
+                            for p in range(2, pages+1):
+                                pending[self.pool.submit(self.page, q, p)] = (q, p, False)
+                    if follow and features:
+                        pending[self.pool.submit(self.page, q, page+1)] = (q, page+1, True)
+                    for item in features:
+                        yield q, item
+        finally:
+            for future in pending:
+                future.cancel()
+
+    #Run a single query and yield its items.
+    def search(self, **query):
+        for q, item in self.items([query]):
+            yield item
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
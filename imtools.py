@@ -4,7 +4,7 @@
 
 import math
 import numpy as np
-from scipy.ndimage import convolve
+from scipy import ndimage
 
 #Accepts an image and a list of functions to run on that image.
 #  Outputs the new image.
@@ -24,57 +24,150 @@ def remove_nodata(im):
 
 #A collection of useful kernels.
 class kernel(object):
-    def __init__(self):
-        
-        self.high_pass = np.array([[ 0,-1, 0],
-                                   [ -1, 5,-1],
-                                   [ 0,-1, 0]])
-        
-        self.blur = np.array([[ 1, 1, 1],
-                              [ 1, 1, 1],
-                              [ 1, 1, 1]])*(1.0/9.0)
-        
-        self.gaussian_blur = np.array([[ 0, 2, 0],
-                                       [ 2, 4, 2],
-                                       [ 0, 2, 0]])
-        
-        self.edge = np.array([[-1,-1,-1],
-                              [-1, 8,-1],
-                              [-1,-1,-1]])
-
-#Applications of the kenerls to imagery.
+    
+    high_pass = np.array([[ 0,-1, 0],
+                          [ -1, 5,-1],
+                          [ 0,-1, 0]])
+    
+    blur = np.array([[ 1, 1, 1],
+                     [ 1, 1, 1],
+                     [ 1, 1, 1]])*(1.0/9.0)
+    low_pass = blur
+    
+    gaussian_blur = np.array([[ 0, 2, 0],
+                              [ 2, 4, 2],
+                              [ 0, 2, 0]])
+    
+    edge = np.array([[-1,-1,-1],
+                     [-1, 8,-1],
+                     [-1,-1,-1]])
+    
+    #A size x size box (mean) kernel.
+    def box(size):
+        return np.full((size,size), 1.0/size**2)
+    
+    #A normalized gaussian kernel, out to radius pixels (default 3 sigma) on each side.
+    def gaussian(sigma,radius=None):
+        radius = int(math.ceil(3*sigma)) if radius is None else radius
+        line = np.exp(-0.5*(np.arange(-radius,radius+1)/sigma)**2)
+        line /= line.sum()
+        return np.outer(line,line)
+
+#Applications of the kenerls to imagery. halo is how many neighbouring pixels each one uses
+#  (see process_raster).
 class convolution(object):
     def sharpen(im):
         return convolve(im,kernel.high_pass)
+    sharpen.halo = 1
+    
     def blur(im):
         return convolve(im,kernel.low_pass)
+    blur.halo = 1
+
+#Kernels up to this many values are applied directly, larger ones through FFTs (see convolve).
+fft_threshold = 81
+
+#Convolve an image with a 2D kernel over two of its axes, the same as scipy.ndimage.convolve with
+#  mode='reflect', picking the fastest engine for the kernel:
+#  'separable': kernels that are an outer product of two lines (box, gaussian) as two 1D passes.
+#  'direct': small kernels (up to fft_threshold values) with ndimage.convolve.
+#  'fft': large kernels through scipy.signal.fftconvolve, on an array padded like mode='reflect'.
+#  axes: the (y, x) axes, so a (band,y,x) image, a (y,x,band) frame or a (time,y,x,band) cube is
+#    convolved in one call (axes=(1,2) for a cube). Default: the last two.
+#  NaN (nodata) pixels stay NaN. With normalize=True (the default for kernels that don't sum to 0),
+#    the pixels around them are averaged over their valid neighbours only (normalized convolution),
+#    instead of becoming NaN as well.
+def convolve(im,weights,engine='auto',axes=(-2,-1),normalize=None):
+    weights = np.asarray(weights, dtype=np.float64)
+    axes = tuple(axis % im.ndim for axis in axes)
+    if normalize is None:
+        normalize = weights.sum() != 0
+    
+    missing = np.isnan(im) if np.issubdtype(im.dtype, np.floating) else None
+    if missing is None or not missing.any():
+        return _convolve(im,weights,engine,axes)
+    
+    filled = np.where(missing, 0, im)
+    if not normalize:
+        out = _convolve(filled,weights,engine,axes)
+        neighbours = _convolve(missing.astype(np.float64),np.abs(weights),engine,axes) > 1e-9
+        out[neighbours] = np.nan
+        return out
+    valid = _convolve((~missing).astype(np.float64),weights,engine,axes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = _convolve(filled,weights,engine,axes) * (weights.sum()/valid)
+    out[missing] = np.nan
+    return out
+
+def _convolve(im,weights,engine,axes):
+    if engine == 'auto':
+        if weights.size > 1 and np.linalg.matrix_rank(weights) == 1:
+            engine = 'separable'
+        elif weights.size <= fft_threshold:
+            engine = 'direct'
+        else:
+            engine = 'fft'
+    
+    if engine == 'separable':
+        u, sv, vt = np.linalg.svd(weights)
+        column, row = u[:,0]*sv[0], vt[0]
+        out = ndimage.convolve1d(np.asarray(im, dtype=np.float64), column, axis=axes[0], mode='reflect')
+        return ndimage.convolve1d(out, row, axis=axes[1], mode='reflect')
+    
+    #The kernel with a length 1 axis for every axis it isn't applied over
+    shape = [1]*im.ndim
+    shape[axes[0]], shape[axes[1]] = weights.shape
+    nd_weights = weights.reshape(shape) if axes[0] < axes[1] else weights.T.reshape(shape)
+    if engine == 'direct':
+        return ndimage.convolve(np.asarray(im, dtype=np.float64), nd_weights, mode='reflect')
+    if engine == 'fft':
+        from scipy.signal import fftconvolve
+        pad = [(0,0)]*im.ndim
+        for axis in axes:
+            size = shape[axis]
+            pad[axis] = (size-1-size//2, size//2)   #Lines up with ndimage's kernel origin
+        return fftconvolve(np.pad(im, pad, mode='symmetric'), nd_weights, mode='valid', axes=axes)
+    raise ValueError(f"{engine} is not a convolution engine. Valid engines are auto, separable, direct and fft.")
 
 '''#########################################################################
 ## Methods for enhancing or otherwise operation on the colors of imagery
 #########################################################################'''
 
-#RGB images only - emphasizes colors. Pretty slow.
+#RGB images - emphasizes colors. Works on a single (y,x,band) image or on a whole
+#  (time,y,x,band) time series in one pass. Adjusts im in place unless an out array is given.
 class contrast(object):
     
     #Significantly increase contrast
-    def emphasize(im):
+    def emphasize(im,out=None):
         alpha = 1.4 # Simple contrast control
         beta = 0    # Simple brightness control
-        return scale_alpha_beta(im,alpha,beta)
+        return scale_alpha_beta(im,alpha,beta,out)
     
     #Significantly increase contrast
-    def exaggerate(im):
+    def exaggerate(im,out=None):
         alpha = 2.0 # Simple contrast control
         beta = 0    # Simple brightness control
-        return scale_alpha_beta(im,alpha,beta)
+        return scale_alpha_beta(im,alpha,beta,out)
 
-#
-def scale_alpha_beta(im,alpha,beta):
-    for y in range(im.shape[0]):
-        for x in range(im.shape[1]):
-            for c in range(im.shape[2]):
-                im[y,x,c] = np.clip(alpha*im[y,x,c] + beta, 0, 255)
-    return im
+#alpha*im + beta, clipped to 0-255, as whole-array operations written into out (default: im).
+#  alpha and beta can also be per-band arrays, which broadcast along the last (band) axis.
+#  Integer images go through a float buffer a few MB at a time and are truncated on the
+#  way back in, the same as assigning the float result into them.
+def scale_alpha_beta(im,alpha,beta,out=None):
+    if out is None:
+        out = im
+    if np.issubdtype(out.dtype, np.floating):
+        np.multiply(im, alpha, out=out)
+        np.add(out, beta, out=out)
+        np.clip(out, 0, 255, out=out)
+    else:
+        step = max(1, 2**21//max(1, im[0].size))    #Leading-axis slices of ~2M values (16 MB)
+        for i in range(0, im.shape[0], step):
+            block = np.multiply(im[i:i+step], alpha, dtype=np.float64)
+            np.add(block, beta, out=block)
+            np.clip(block, 0, 255, out=block)
+            np.copyto(out[i:i+step], block, casting='unsafe')
+    return out
 
 '''#########################################################################
 ## Remaps and rescales
@@ -105,15 +198,201 @@ def scale(im,low_value,high_value,low_threshold,high_threshold):
     im[indices] = ( high_value * (im[indices] - low_threshold) / (high_threshold - low_threshold) )
     return im
 
+'''#########################################################################
+## Block-wise processing of rasters
+#########################################################################'''
+
+#Run a processing stack over a raster one block at a time, and write the result to a new raster.
+#  The blocks are the source's internal tiles (512x512 windows if it isn't tiled), read as float with
+#  nodata as NaN like mio.process_image, so memory is bounded by the block size and the number of
+#  workers instead of the raster size. Blocks are processed on a pool of threads (GDAL and numpy
+#  release the GIL), and written as they finish, tiled like the source.
+#  halo: pixels of overlap read around each block, for operations that use neighbouring pixels
+#    (convolutions). Defaults to the sum of the operations' halo attributes (none for pointwise ones).
+#    With enough halo the result is the same as processing the whole raster at once.
+#  bands: the band indexes to process (default: all), passed to each operation as one (band,y,x) block.
+#  dtype/nodata: the output data type, and the value NaN is written as (None keeps NaN).
+def process_raster(src_path,dst_path,operations,halo=None,workers=4,dtype=np.float32,nodata=None,bands=None):
+    import threading
+    import rasterio as rio
+    from rasterio.windows import Window
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+
+    if halo is None:
+        halo = sum(getattr(function, 'halo', 0) for function in operations)
+    local = threading.local()   #One reader per thread, a dataset can't be read from several at once
+    readers = []
+
+    with rio.open(src_path) as src:
+        indexes = list(range(1, src.count+1)) if bands is None else list(bands)
+        height, width, src_nodata = src.height, src.width, src.nodata
+        profile = src.profile.copy()
+        if profile.get('tiled'):
+            blockysize, blockxsize = src.block_shapes[0]
+            windows = [window for ij, window in src.block_windows(1)]
+        else:
+            blockysize = blockxsize = 512
+            windows = [Window(col, row, min(512, width-col), min(512, height-row)) for row in range(0, height, 512) for col in range(0, width, 512)]
+    profile.update(driver='GTiff', count=len(indexes), dtype=np.dtype(dtype).name, nodata=nodata,
+                   tiled=True, blockxsize=blockxsize, blockysize=blockysize, compress='lzw')
+
+    def run(window):
+        if not hasattr(local, 'src'):
+            local.src = rio.open(src_path)
+            readers.append(local.src)
+        row, col = int(window.row_off), int(window.col_off)
+        rows, cols = int(window.height), int(window.width)
+        top, left = max(0, row-halo), max(0, col-halo)
+        bottom, right = min(height, row+rows+halo), min(width, col+cols+halo)
+        block = local.src.read(indexes, window=Window(left, top, right-left, bottom-top)).astype(np.float64)
+        if src_nodata is not None:
+            block[block==src_nodata] = np.nan
+        with np.errstate(invalid='ignore', divide='ignore'):
+            block = process(block,operations)[:, row-top:row-top+rows, col-left:col-left+cols]
+            if nodata is not None:
+                block = np.where(np.isnan(block), nodata, block)
+            return window, block.astype(dtype)
+
+    try:
+        with rio.open(dst_path, 'w', **profile) as dst, ThreadPoolExecutor(max_workers=workers) as pool:
+            def write(future):
+                window, block = future.result()
+                dst.write(block, window=window)
+            running = deque()   #Blocks in flight, capped so finished ones don't pile up in memory
+            for window in windows:
+                running.append(pool.submit(run, window))
+                while len(running) > 2*workers:
+                    write(running.popleft())
+            while running:
+                write(running.popleft())
+    finally:
+        for reader in readers:
+            reader.close()
+    return dst_path
+
 '''#########################################################################
 ## Upsampling and downsampling
 #########################################################################'''
 
-place = 'holder'
+#Resampling works over two axes of 2D-4D arrays: the last two by default, as in a (band,y,x) image,
+#  or e.g. axes=(1,2) for a (time,y,x,band) cube. factor is one number or a (y, x) pair. Pixels that
+#  are NaN or equal to nodata are left out, and resampled pixels with no valid data come out as
+#  NaN (mean, upsample) or nodata (mode).
+
+#Per-axis factors and the other axes.
+def _resample_axes(im,factor,axes):
+    axes = tuple(axis % im.ndim for axis in axes)
+    factors = (factor, factor) if np.isscalar(factor) else tuple(factor)
+    #Axes in increasing order (with their factors), whichever order they were given in
+    order = np.argsort(axes)
+    return tuple(axes[i] for i in order), tuple(factors[i] for i in order)
+
+#Downsample by whole factors, reducing each factor x factor block to one pixel through a reshape
+#  (no loops). 'mean' for continuous data (reflectance, indices), 'mode' for classes (Fmask).
+#  Edges that don't fill a whole block are reduced from the pixels they have.
+def downsample(im,factor=2,method='mean',axes=(-2,-1),nodata=None):
+    axes, factors = _resample_axes(im,factor,axes)
+    factors = tuple(int(f) for f in factors)
+    
+    valid = ~np.isnan(im) if np.issubdtype(im.dtype, np.floating) else np.ones(im.shape, bool)
+    if nodata is not None:
+        valid &= im != nodata
+    
+    #Pad the two axes to whole blocks (as missing pixels), then split each into (blocks, factor)
+    pad = [(0,0)]*im.ndim
+    for axis, f in zip(axes, factors):
+        pad[axis] = (0, -im.shape[axis] % f)
+    if any(p[1] for p in pad):
+        im, valid = np.pad(im, pad), np.pad(valid, pad)
+    shape = []
+    for axis, size in enumerate(im.shape):
+        shape += [size//factors[axes.index(axis)], factors[axes.index(axis)]] if axis in axes else [size]
+    block_axes = (axes[0]+1, axes[1]+2)
+    
+    if method == 'mean':
+        values = np.where(valid, im, 0).reshape(shape)
+        counts = valid.reshape(shape).sum(axis=block_axes)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return values.sum(axis=block_axes, dtype=np.float64) / counts
+    
+    if method == 'mode':
+        #Move each block's values to a last axis, sort them, and find the longest run of equal values
+        values = np.moveaxis(im.reshape(shape), block_axes, (-2,-1))
+        values = values.reshape(values.shape[:-2] + (-1,))
+        valid = np.moveaxis(valid.reshape(shape), block_axes, (-2,-1)).reshape(values.shape)
+        order = np.argsort(values, axis=-1, kind='stable')
+        values = np.take_along_axis(values, order, -1)
+        valid = np.take_along_axis(valid, order, -1)
+        position = np.arange(values.shape[-1])
+        starts = np.ones(values.shape, bool)
+        starts[...,1:] = values[...,1:] != values[...,:-1]
+        run_start = np.maximum.accumulate(np.where(starts, position, 0), axis=-1)
+        counted = np.cumsum(valid, axis=-1)     #Missing pixels don't count towards a run
+        runs = counted - np.take_along_axis(counted - valid, run_start, -1)
+        runs[~valid] = 0
+        best = runs.argmax(axis=-1)[...,np.newaxis]
+        out = np.take_along_axis(values, best, -1)[...,0]
+        empty = ~valid.any(axis=-1)
+        if empty.any():
+            out = out.astype(np.float64) if nodata is None else out
+            out[empty] = np.nan if nodata is None else nodata
+        return out
+    
+    raise ValueError(f"{method} is not a downsampling method. Valid methods are mean and mode.")
 
-#Upsample
+#Upsample by any factor with 'nearest', 'bilinear' or 'cubic' interpolation (scipy.ndimage.zoom,
+#  with pixels treated as areas so the result lines up with the source grid). Whole factors with
+#  'nearest' are a plain repeat. Missing pixels don't bleed into their neighbours: values are
+#  interpolated from the valid pixels only (normalized), and pixels that fall in a missing source
+#  pixel stay missing.
+def upsample(im,factor=2,method='bilinear',axes=(-2,-1),nodata=None):
+    axes, factors = _resample_axes(im,factor,axes)
+    orders = {'nearest': 0, 'bilinear': 1, 'cubic': 3}
+    if method not in orders:
+        raise ValueError(f"{method} is not an upsampling method. Valid methods are nearest, bilinear and cubic.")
+    
+    if method == 'nearest' and all(float(f).is_integer() for f in factors):
+        for axis, f in zip(axes, factors):
+            im = np.repeat(im, int(f), axis=axis)
+        return im
+    
+    from scipy.ndimage import zoom
+    zooms = [1]*im.ndim
+    for axis, f in zip(axes, factors):
+        zooms[axis] = f
+    def resample(array, order):
+        return zoom(array, zooms, order=order, mode='nearest', grid_mode=True)
+    
+    missing = np.isnan(im) if np.issubdtype(im.dtype, np.floating) else np.zeros(im.shape, bool)
+    if nodata is not None:
+        missing |= im == nodata
+    if not missing.any():
+        return resample(np.asarray(im, dtype=np.float64), orders[method])
+    
+    valid = (~missing).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = resample(np.where(missing, 0, im).astype(np.float64), orders[method]) / resample(valid, orders[method])
+    out[resample(valid, 0) == 0] = np.nan
+    return out
 
-#Downsample
+#Read a raster resampled by rasterio (GDAL) while reading, so the full-resolution data is never in
+#  memory. Reads coarser than the file come from its overviews where it has them.
+#  factor: < 1 to downsample (e.g. 0.25 for 30 m to 120 m), > 1 to upsample; or give out_shape (rows, cols).
+#  method: a rasterio Resampling name: 'average', 'mode', 'nearest', 'bilinear', 'cubic', ...
+#  Returns a (band,y,x) float array with nodata as NaN (like mio.process_image), and its transform.
+def read_resampled(path,factor=None,out_shape=None,method='average',bands=None):
+    import rasterio as rio
+    from rasterio.enums import Resampling
+    with rio.open(path) as src:
+        indexes = list(range(1, src.count+1)) if bands is None else list(bands)
+        if out_shape is None:
+            out_shape = (max(1, round(src.height*factor)), max(1, round(src.width*factor)))
+        array = src.read(indexes, out_shape=(len(indexes),) + tuple(out_shape), resampling=Resampling[method]).astype(np.float64)
+        if src.nodata is not None:
+            array[array==src.nodata] = np.nan
+        transform = src.transform * src.transform.scale(src.width/out_shape[1], src.height/out_shape[0])
+    return array, transform
 
 '''#########################################################################
 ## Common band combinations and processing stacks
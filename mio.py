@@ -3,10 +3,12 @@
 #Generalized data and functions for handling HLS data.
 
 import os
+import re
+import json
+import importlib.util
 import datetime
 import glob
 import sys
-import imageio.v3 as imio
 import numpy as np
 import math
 from imtools import *
@@ -14,6 +16,9 @@ import rasterio as rio
 import imageio
 import matplotlib.pyplot as plt
 import io
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
 
 '''#########################################################################
 ## General Info
@@ -65,37 +70,156 @@ class VI(object):
     NBR2  = lambda SWIR1,SWIR2:    (SWIR1-SWIR2)/(SWIR1+SWIR2)                                     #Normalized Burn Ratio 2
     TVI   = lambda NIR,green,red:  (120.0*(NIR-green)-200.0*(red-green))/2.0                       #Triangular Vegetation Index
 
+#The same recipes as expressions for compute_VI, which evaluates them without the full-size
+#  temporaries of the lambdas above. Variable names are the VI argument names.
+VI_expressions = {
+    'NDVI':  '(NIR-red)/(NIR+red)',
+    'EVI':   '2.5*(NIR-red)/(NIR+6.0*red-7.5*blue+1)',
+    'SAVI':  '1.5*(NIR-red)/(NIR+red+0.5)',
+    'MSAVI': '(2.0*NIR+1.0*(sqrt(2.0*NIR+1.0))**2.0-8.0*(NIR-red))/2.0',
+    'NDMI':  '(NIR-SWIR1)/(NIR+SWIR1)',
+    'NDWI':  '(green-NIR)/(green+NIR)',
+    'NBR':   '(NIR-SWIR2)/(NIR+SWIR2)',
+    'NBR2':  '(SWIR1-SWIR2)/(SWIR1+SWIR2)',
+    'TVI':   '(120.0*(NIR-green)-200.0*(red-green))/2.0'}
+
+#numexpr evaluates expressions in cache-sized blocks on several threads. Without it, compute_VI
+#  falls back to numpy over chunks of the arrays.
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
 '''#########################################################################
 ## Basic functions
 #########################################################################'''
 
+#Split an HLS file name (HLS.S30.T10SEG.2021001T184729.v2.0.B04.tif) into its collection ID,
+#  sensor, tile, acquisition date string and band. Returns None if it isn't an HLS name.
+hls_name = re.compile(r'(HLS\.(\w+)\.(T\w{5})\.(\d{7}T\d{6})\.v\d+\.\d+)\.([^.]+)')
+def parse_name(file):
+    match = hls_name.match(os.path.basename(file))
+    return None if match is None else match.groups()
+
 #The line of code below will return a list of all HLS files in a folder.
 #  By default, also includes all subfolders.
 #  If a folder isn't provided, it uses the current folder.
-def find(path=os.getcwd(),check_subfols=True):
+#  Folders are listed with os.scandir on a pool of worker threads. If a manifest file is given, the
+#  listing of every folder (HLS file names, their parsed parse_name attributes, and subfolders) is
+#  kept there with the folder's modification time, and on the next call only folders that changed
+#  since are listed again; the rest only cost a stat.
+def find(path=None,check_subfols=True,manifest=None,workers=8):
+    path = os.getcwd() if path is None else path
+    saved = {}
+    if manifest is not None and os.path.exists(manifest):
+        with open(manifest) as f:
+            saved = json.load(f)['folders']
+    
+    folders = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(scan_folder, path, saved.get(path))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder, listing = future.result()
+                if listing is None:
+                    continue                                   #Removed while scanning
+                folders[folder] = listing
+                if check_subfols:
+                    for sub in listing['subfolders']:
+                        sub = os.path.join(folder, sub)
+                        pending.add(pool.submit(scan_folder, sub, saved.get(sub)))
+    
+    #Merge into the saved listings, so a call that didn't scan subfolders keeps theirs. A full scan
+    #  replaces everything under path, dropping the folders that no longer exist.
+    if manifest is not None:
+        merged = {folder: listing for folder, listing in saved.items()
+                  if not (check_subfols and (folder == path or folder.startswith(os.path.join(path, ''))))}
+        merged.update(folders)
+        if merged != saved:
+            temp = f"{manifest}.{os.getpid()}.part"
+            with open(temp, 'w') as f:
+                json.dump({'root': path, 'folders': merged}, f)
+            os.replace(temp, manifest)
+    
     file_list = []
-    if check_subfols:
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                is_valid = file.endswith('.tif')
-                if(file.startswith('HLS.')) and is_valid:
-                    file_list.append(os.path.join(root,file))
-    
-    else:
-        for file in os.listdir():
-            is_valid = file.endswith('.tif')
-            if(file.startswith('HLS.')) and is_valid:
-                    file_list.append(os.path.join(path,file))
-    return file_list
+    for folder, listing in folders.items():
+        for file in listing['files']:
+            file_list.append(os.path.join(folder,file))
+    return sorted(file_list)
+
+#List one folder for find. A previous listing is reused if the folder hasn't been modified since.
+def scan_folder(folder,listing=None):
+    try:
+        mtime = os.stat(folder).st_mtime_ns
+        if listing is not None and listing['mtime'] == mtime:
+            return folder, listing
+        files, subfolders = {}, []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.name)
+                elif entry.name.startswith('HLS.') and entry.name.endswith('.tif'):
+                    files[entry.name] = parse_name(entry.name)
+    except FileNotFoundError:
+        return folder, None
+    return folder, {'mtime': mtime, 'files': files, 'subfolders': subfolders}
 
 def process_image(im,processes):
-    reader = rio.open(im)                #Create a reader object
-    array = reader.read()                #Ingest the array
+    with rio.open(im) as reader:         #Create a reader object
+        array = reader.read()            #Ingest the array
     array = np.where(array==-9999, np.nan, array)         #Remove nodata values
     array = process(array,processes)     #Put through a processing stack
     #array = array.astype(rio.uint8)      #Fit to 8-bit
     return array
 
+#Compute one or more vegetation indices from one set of band arrays.
+#  bands maps band IDs to same-shaped arrays, e.g. {'B8A': nir, 'B04': red, 'B02': blue}. Each
+#  index takes its bands from band_combinations, so bands shared by several indices are only
+#  read (and converted to dtype) once. Pass float32 as dtype to halve the memory of float64.
+#  Pixels equal to nodata (or NaN) in any band used by an index, and divisions by zero, come
+#  out as NaN without warnings. Results are written to preallocated arrays, or to the arrays
+#  in out ({index: C-contiguous array}) if given, and returned as {index: array}.
+def compute_VI(bands,indices=('EVI',),dtype=np.float64,nodata=-9999,out=None,chunk=2**18):
+    if isinstance(indices, str):
+        indices = [indices]
+    out = {} if out is None else out
+
+    #Convert each band once, with nodata values as NaN (copying rather than editing the caller's array)
+    arrays = {}
+    for index in indices:
+        for band in getattr(band_combinations, index.lower()):
+            if band in arrays:
+                continue
+            array = np.asarray(bands[band], dtype=dtype)
+            if nodata is not None:
+                missing = array == nodata
+                if missing.any():
+                    if np.shares_memory(array, bands[band]):
+                        array = array.copy()
+                    array[missing] = np.nan
+            arrays[band] = np.ascontiguousarray(array).reshape(-1)
+
+    for index in indices:
+        expression = VI_expressions[index]
+        index_bands = getattr(band_combinations, index.lower())
+        names = getattr(VI, index).__code__.co_varnames                     #Lambda arguments, in band_combinations order
+        variables = dict(zip(names, [arrays[b] for b in index_bands]))
+        if index not in out:                                                #Only allocate when the caller didn't pass one
+            out[index] = np.empty(np.shape(bands[index_bands[0]]), dtype)
+        result = out[index]
+        flat = result.reshape(-1)
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if numexpr is not None:
+                numexpr.evaluate(expression, local_dict=variables, out=flat, casting='unsafe')
+            for i in range(0, flat.size, chunk):
+                block = flat[i:i+chunk]
+                if numexpr is None:
+                    block[...] = eval(expression, {'sqrt': np.sqrt}, {n: v[i:i+chunk] for n, v in variables.items()})
+                block[np.isinf(block)] = np.nan                             #x/0
+    return out
+
 def get_metadata(tif_path):
     """
     Extract metadata from a .tif file.
@@ -130,11 +254,6 @@ def plot_vi_meta_to_image(vi_array, metadata, vi_choice, cmap="RdYlGn"):
     Example:
     plot_buffer = plot_vi_meta_to_image(vi_array, metadata, 'NDVI')
     """
-    
-    sensing_time = metadata.get('SENSING_TIME', 'N/A')
-    spacecraft_name = metadata.get('SPACECRAFT_NAME', 'N/A')
-    coordinate_system = metadata.get('HORIZONTAL_CS_NAME', 'N/A')
-    spatial_resolution = metadata.get('SPATIAL_RESOLUTION', 'N/A')
 
     fig, ax = plt.subplots(figsize=(10,10))
     
@@ -145,8 +264,7 @@ def plot_vi_meta_to_image(vi_array, metadata, vi_choice, cmap="RdYlGn"):
     ax.set_yticks([])  # Remove y-axis tick labels
     
     # Construct a title using the extracted metadata
-    title = f"{vi_choice} from {spacecraft_name} on {sensing_time}\nCoordinate System: {coordinate_system} | Spatial Resolution: {spatial_resolution}m"
-    ax.set_title(title, fontsize=10)
+    ax.set_title(vi_title(metadata, vi_choice), fontsize=10)
     
     buf = io.BytesIO()
     plt.savefig(buf, format="png")
@@ -155,6 +273,103 @@ def plot_vi_meta_to_image(vi_array, metadata, vi_choice, cmap="RdYlGn"):
     
     return buf
 
+#The frame title used by plot_vi_meta_to_image and render_vi_frame.
+def vi_title(metadata, vi_choice):
+    sensing_time = metadata.get('SENSING_TIME', 'N/A')
+    spacecraft_name = metadata.get('SPACECRAFT_NAME', 'N/A')
+    coordinate_system = metadata.get('HORIZONTAL_CS_NAME', 'N/A')
+    spatial_resolution = metadata.get('SPATIAL_RESOLUTION', 'N/A')
+    return f"{vi_choice} from {spacecraft_name} on {sensing_time}\nCoordinate System: {coordinate_system} | Spatial Resolution: {spatial_resolution}m"
+
+#The figure render_vi_frame draws into: one per process, built once and reused for every frame.
+frame_figure = None
+
+#Build this process' frame figure. Also the initializer of the rendering process pool in
+#  create_VI_time_series, so each worker sets up matplotlib once rather than per frame.
+def init_frame_worker(cmap="RdYlGn"):
+    global frame_figure
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(10,10))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    im = ax.imshow(np.zeros((1,1)), cmap=cmap, vmin=-1, vmax=1)
+    ax.set_xticks([])  # Remove x-axis tick labels
+    ax.set_yticks([])  # Remove y-axis tick labels
+    frame_figure = (cmap, fig, ax, im)
+
+#The same frame as plot_vi_meta_to_image, drawn into the reusable figure and returned as an RGB
+#  uint8 array (no PNG encode and decode). Safe to run in worker processes.
+def render_vi_frame(vi_array, metadata, vi_choice, cmap="RdYlGn"):
+    if frame_figure is None or frame_figure[0] != cmap:
+        init_frame_worker(cmap)
+    cmap, fig, ax, im = frame_figure
+    im.set_data(vi_array)
+    im.set_extent((-0.5, vi_array.shape[1]-0.5, vi_array.shape[0]-0.5, -0.5))
+    ax.set_title(vi_title(metadata, vi_choice), fontsize=10)
+    fig.canvas.draw()
+    return np.asarray(fig.canvas.buffer_rgba())[:,:,:3].copy()
+
+
+#Open a writer that adds frames to an animation one at a time with append_data(frame), writing each
+#  frame out as it comes instead of collecting them all for one imwrite. Use it as a context manager.
+#  duration is how long each frame is shown, in milliseconds.
+#  .gif is encoded by pillow; .mp4 (and other video formats) and .webp are piped to ffmpeg (imageio-ffmpeg).
+def animation_writer(name,duration=1000):
+    if name.lower().endswith('.gif'):
+        return imageio.get_writer(name, format='GIF-PIL', mode='I', duration=duration/1000, loop=0)
+    if importlib.util.find_spec('imageio_ffmpeg') is None:
+        raise ImportError(f"Writing {os.path.splitext(name)[1]} animations requires ffmpeg through imageio-ffmpeg. Install it with "
+                          "'conda install -c conda-forge imageio-ffmpeg' or 'pip install imageio-ffmpeg', or write a .gif instead.")
+    if name.lower().endswith('.webp'):
+        return webp_writer(name, duration)
+    return imageio.get_writer(name, mode='I', fps=1000/duration)
+
+#Animated .webp writer for animation_writer. imageio's ffmpeg plugin only writes video containers,
+#  so frames are piped to ffmpeg's libwebp_anim encoder directly.
+class webp_writer(object):
+    def __init__(self,name,duration=1000):
+        self.name = name
+        self.fps = 1000/duration
+        self._frames = None
+    
+    def append_data(self,frame):
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if self._frames is None:
+            import imageio_ffmpeg
+            self._frames = imageio_ffmpeg.write_frames(self.name, (frame.shape[1], frame.shape[0]),
+                                                       pix_fmt_in='gray' if frame.ndim == 2 else 'rgb24',
+                                                       fps=self.fps, codec='libwebp_anim', macro_block_size=1,
+                                                       output_params=['-loop', '0'])
+            self._frames.send(None)
+        self._frames.send(frame)
+    
+    def close(self):
+        if self._frames is not None:
+            self._frames.close()
+            self._frames = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
+
+#A colormap as a lookup table for vi_to_rgb: 256 RGB colors, plus the nodata color at index 256.
+def colormap_lut(cmap="RdYlGn",nodata=(255,255,255)):
+    colors = np.round(plt.get_cmap(cmap)(np.linspace(0, 1, 256))[:,:3]*255)
+    return np.vstack([colors, nodata]).astype(np.uint8)
+
+#Color a vegetation index (2D) straight to an RGB uint8 frame through a colormap_lut, with the same
+#  256 color bins as imshow(vmin, vmax). NaN pixels get the nodata color. No matplotlib figure is drawn.
+def vi_to_rgb(vi_array,lut,vmin=-1,vmax=1):
+    index = np.subtract(vi_array, vmin, dtype=np.float32)
+    np.multiply(index, 256/(vmax-vmin), out=index)
+    np.clip(index, 0, 255, out=index)
+    with np.errstate(invalid='ignore'):
+        index = index.astype(np.uint16)
+    index[np.isnan(vi_array)] = 256
+    return lut[index]
 
 #Takes lists of HLS files and turns them into a dictionary divided by collection.
 #  If called, it gives a brief summary of the dataset.
@@ -167,38 +382,49 @@ class granules(object):
     def __init__(self,file_list=[], reversed=False):
         
         #Establish variables. Add the initial dataset if there is 1.
-        self.collects = {}
+        self.collects = {}      #Collection ID: [files]
+        self.bands = {}         #Collection ID: {band: file}
+        self.info = {}          #Collection ID: {'sensor', 'tile', 'datetime'}
+        self._keys = []         #(datetime, collection ID), always earliest first
         self.dates = []
+        self.order = []
         self.reversed = reversed
         self._index = 0
         self.add(file_list)
     
-    #Add files to into a sorted dictionary, then call order_historically below.
+    #Add files to the index, then call order_historically below.
+    #  Each name is parsed once, and each collection's date is only parsed for its first file.
     def add(self,file_list):
+        new = []
         for file in file_list:
-            cid = file[file.rfind('HLS'):file.rfind('.v2.0')+5]
-            if cid in self.collects.keys():
+            name = parse_name(file)
+            if name is None:
+                print(f"Not an HLS file name: {file}")
+                continue
+            cid, sensor, tile, date, band = name
+            if cid not in self.collects:
+                date = datetime.datetime.strptime(date, "%Y%jT%H%M%S")
+                self.collects[cid] = []
+                self.bands[cid] = {}
+                self.info[cid] = {'sensor': sensor, 'tile': tile, 'datetime': date}
+                new.append((date, cid))
+            if self.bands[cid].get(band) != file:
+                self.bands[cid][band] = file
                 self.collects[cid].append(file)
-            else:
-                self.collects[cid] = [file]
-                try:
-                    self.dates.append(datetime.datetime.strptime(file.split(".")[3],"%Y%jT%H%M%S"))
-                except ValueError:
-                    self.dates.append(datetime.datetime(2022, 3, 21, 21, 9, 31))
-                    print(file)
-                    
+        
+        #The existing keys are already sorted, so this is a merge of the new ones (O(n + k log k))
+        self._keys.extend(new)
+        self._keys.sort()
         self.order_historically()
     
     #Sort files by date.
     def order_historically(self):
-        self.dates = sorted(self.dates)
-        dateStrings = [f"{date:%Y%jT%H%M%S}" for date in self.dates]
+        keys = reversed(self._keys) if self.reversed else self._keys
+        self.dates = []
         self.order = []
-        for date in dateStrings:
-            files = [key for key, value in self.collects.items() if date in key]
-            self.order.extend(set(files))
-        if self.reversed:
-            self.reverse()
+        for date, cid in keys:
+            self.dates.append(date)
+            self.order.append(cid)
     
     #Reverse the dataset. Data is stored from earliest to most-recent unless self.reversed = True.
     def reverse(self):
@@ -206,6 +432,16 @@ class granules(object):
         self.order.reverse()
         self.reversed = not self.reversed
     
+    #The file of one band of a collection.
+    def band_file(self,cid,band):
+        return self.bands[cid][band]
+    
+    #A granule handle for a collection ID (or its position in the date order).
+    def granule(self,cid):
+        if isinstance(cid, int):
+            cid = self.order[cid]
+        return granule(self.collects[cid], self.bands[cid])
+    
     #Print a summation of the contents of the dictionary.
     def total(self):
         collects = list(self.collects.keys())
@@ -233,112 +469,170 @@ class granules(object):
             return message
     
     #
-    def create_time_series(self,bands=band_combinations.rgb,processes=stack.simpleRGB):
+    #Build a (time, y, x, band) cube of the processed bands of every collection, in date order, on disk.
+    #  path: a .npy file (memory mapped) or, if zarr is installed, a .zarr store chunked one frame by
+    #    512x512 pixels. Collections are written one at a time and nothing else is kept, so memory
+    #    use doesn't grow with the length of the series.
+    #  dtype: uint8 for display (values are truncated, as astype does) or e.g. float32 for analysis.
+    #  max_pixels/resolution: build a reduced-resolution cube, e.g. for previews, read from the files'
+    #    overviews (see granule.read_shape). Every collection is read at the first one's shape.
+    def build_cube(self,path,bands=band_combinations.rgb,processes=stack.simpleRGB,dtype=np.uint8,max_pixels=None,resolution=None):
         numBands = len(bands)
-
-        if numBands == 1:
-            pass
+        numCollects = len(self.order)                                   #Get the size of the current collection
+        with self.granule(0) as firstImage:                             #Get the first image in this object
+            readShape = firstImage.read_shape(bands[0],max_pixels,resolution)
+            arrayShape = firstImage.open(bands[0]).shape if readShape is None else readShape #Its size is in the header, nothing is read yet
         
-        elif numBands == 3:
-            numCollects = len(list(self.collects.keys()))                   #Get the size of the current collection
-            firstImage = next(self)                                         #Get the first image in this object
-            firstBand = bands[0]                                            #Get the first band to look at
-            
-            currentCollect = list(firstImage.keys())[0]                     #Get the collection ID
-            imageFiles = list(firstImage.values())[0]                       #Get the list of image files
-            firstBandFile = [im for im in imageFiles if firstBand in im][0] #Get the image file associated with the first image to form
-            array = process_image(firstBandFile,processes)                  #Open, process and prepare the image for output
-            
-            arrayShape = list(array.shape)                                         #We can now preallocate memory for the time series
-            timeSeriesShape = [numCollects,arrayShape[1],arrayShape[2],numBands] #This will be a 4D array with dimensions:
-            timeSeries = np.zeros(timeSeriesShape)                                 #Time,Band,X,Y
-            timeSeries[0,:,:,0] = array                                            #Add images by: timeSeries[collect,:,:,band]
-            
-            thisBand = [im for im in imageFiles if bands[1] in im][0]       #Now iterate through the next 2 bands
-            array = process_image(thisBand,processes)
-            timeSeries[0,:,:,1] = array
-            thisBand = [im for im in imageFiles if bands[2] in im][0]
-            array = process_image(thisBand,processes)
-            timeSeries[0,:,:,2] = array
+        timeSeriesShape = (numCollects,arrayShape[0],arrayShape[1],numBands) #This will be a 4D array with dimensions:
+        if path.endswith('.zarr'):                                            #Time,Y,X,Band
+            import zarr
+            timeSeries = zarr.open(path, mode='w', shape=timeSeriesShape, dtype=dtype,
+                                   chunks=(1,min(arrayShape[0],512),min(arrayShape[1],512),numBands))
+        else:
+            timeSeries = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=timeSeriesShape)
+        #Without processing, float bands are read straight into the memory mapped cube
+        direct = not processes and isinstance(timeSeries, np.memmap) and np.issubdtype(dtype, np.floating)
+        bandsFrame = None if direct else np.empty(timeSeriesShape[1:], np.float64) #One collection as read, reused for each
+        frame = None if direct else np.empty(timeSeriesShape[1:], dtype)           #One collection, processed
+        
+        for collectInd,collection_name in enumerate(self.order):                   #Now iterate through the entire collection
+            print('  Adding {} to the time series.'.format(collection_name))
             
-            for collectInd,collection_name in enumerate(self.order):                   #Now iterate through the entire collection               #
-                imageFiles = list(self.collects[collection_name])                   #
-                print('  Adding {} to the time series.'.format(collection_name))
-                
-                for bandInd,band in enumerate(bands):                       #Iterate through the bands
-                    thisBand = [im for im in imageFiles if band in im][0]   #
-                    array = process_image(thisBand,processes)
-                    timeSeries[collectInd,:,:,bandInd] = array
-                
-            print('Converting to uint8')
-            timeSeries = timeSeries.astype(rio.uint8)
+            with self.granule(collection_name) as image:
+                image.read_bands(bands, out=timeSeries[collectInd] if direct else bandsFrame, out_shape=arrayShape) #All bands at once
+            if direct:
+                continue
+            for bandInd in range(numBands):                                 #Iterate through the bands
+                with np.errstate(invalid='ignore'):
+                    np.copyto(frame[:,:,bandInd], process(bandsFrame[np.newaxis,:,:,bandInd],processes)[0], casting='unsafe')
+            timeSeries[collectInd] = frame
+        
+        if isinstance(timeSeries, np.memmap):
+            timeSeries.flush()
+        return timeSeries
+    
+    #Create a .gif of the bands of every collection. The cube is built on disk (see build_cube) and the
+    #  frames are streamed from it into the .gif one at a time. Pass cube='name.npy' (or .zarr) to keep it,
+    #  otherwise a temporary file is used and removed afterwards. Pass max_pixels (e.g. 1000*1000) or
+    #  resolution (meters) to make the .gif from the files' overviews instead of the full resolution.
+    def create_time_series(self,bands=band_combinations.rgb,processes=stack.simpleRGB,cube=None,name="test2.gif",max_pixels=None,resolution=None):
+        numBands = len(bands)
+
+        if numBands not in (1,3):
+            return
+        
+        keep = cube is not None
+        if not keep:
+            handle, cube = tempfile.mkstemp(suffix='.npy')
+            os.close(handle)
+        timeSeries = None
+        try:
+            timeSeries = self.build_cube(cube,bands,processes,max_pixels=max_pixels,resolution=resolution)
             print('Creating .gif file')
-            imio.imwrite(f"test2.gif",timeSeries,duration=1000)
+            with animation_writer(name,duration=1000) as writer:
+                for collectInd in range(timeSeries.shape[0]):
+                    frame = timeSeries[collectInd]
+                    writer.append_data(frame[:,:,0] if numBands == 1 else frame)
+        finally:
+            if not keep:
+                timeSeries = None                   #Release the memory map before removing its file
+                os.remove(cube)
+        return timeSeries
                             
-    def create_VI_time_series(self,VI_choice = 'EVI',processes=stack.simpleRGB):
+    def create_VI_time_series(self,VI_choice = 'EVI',processes=stack.simpleRGB,dtype=np.float64,render='matplotlib',fmt='gif',cmap="RdYlGn",workers=1,max_pixels=None,resolution=None):
         """
-        Process vegetation index time series for a given VI choice, create a GIF, and save it.
+        Process vegetation index time series for one or more VI choices, and stream each to an animation.
+
+        Each collection's indices are rendered as soon as they are computed and appended to the
+        animation, so only one collection is held in memory however long the series is.
 
         Parameters:
-        - VI_choice (str, optional): The vegetation index choice. Default is 'EVI'.
-        - processes (int, optional): The number of processes to use for parallel processing. Default is 1.
+        - VI_choice (str or list, optional): The vegetation index choice, or a list of them. Bands shared
+          by several indices are only read once per collection. Default is 'EVI'.
+        - processes (list, optional): The processing stack applied to each band. Default is stack.simpleRGB.
+        - dtype (optional): The data type the indices are computed in, e.g. np.float32. Default is np.float64.
+        - render (str, optional): 'matplotlib' draws each frame as a titled figure (see render_vi_frame).
+          'lut' colors the index straight to RGB through a lookup table (vi_to_rgb), skipping matplotlib
+          figures; much faster, at the source resolution, without title. Default is 'matplotlib'.
+        - fmt (str, optional): The animation format: 'gif', 'mp4' or 'webp'. Default is 'gif'.
+        - cmap (str, optional): The colormap. Default is "RdYlGn".
+        - workers (int, optional): Processes that draw 'matplotlib' frames, each with its own reusable figure.
+          Frames are drawn while the next collections are read and are still written in order. Each index
+          is sent to a worker, so dtype=np.float32 halves that traffic. Default is 1.
+        - max_pixels (int, optional): Read each collection at no more than this many pixels, e.g. 1000*1000
+          for a 10 inch frame, from the closest overview level of the files (see granule.read_shape).
+          Default is None (full resolution).
+        - resolution (float, optional): Read each collection at no finer than this resolution in meters, e.g. 120.
+          Default is None (full resolution).
 
         Raises:
         - Prints an error message if an invalid VI choice is provided and defaults to 'EVI'.
 
         Example:
-        granule.create_VI_time_series(VI_choice = 'NDVI')
+        granule.create_VI_time_series(VI_choice = ['NDVI', 'EVI'], render='lut', fmt='mp4')
         """
-        metadata_collection = {}
-        vegetation_index_arrays = []
-        acutal_order = []
-        bands = getattr(band_combinations, VI_choice.lower(), None)
-
-        vi_function = getattr(VI, VI_choice, None)
-        if vi_function is None:
-            print(f"Invalid VI value: {VI_choice}. Using default EVI.")
-            vi_function = VI.EVI
+        VI_choices = [VI_choice] if isinstance(VI_choice, str) else list(VI_choice)
+        for i, choice in enumerate(VI_choices):
+            if choice not in VI_expressions:
+                print(f"Invalid VI value: {choice}. Using default EVI.")
+                VI_choices[i] = 'EVI'
+        VI_choices = list(dict.fromkeys(VI_choices))
+        bands = list(dict.fromkeys(band for choice in VI_choices for band in getattr(band_combinations, choice.lower())))
+        lut = colormap_lut(cmap) if render == 'lut' else None
         
-        def generate_gif():
-                frames = []
-                for series, collection_name in zip(vegetation_index_arrays, acutal_order):
-                    metadata = metadata_collection[collection_name]
-                    buf = plot_vi_meta_to_image(series[0], metadata, VI_choice)
-                    frames.append(imageio.imread(buf))
-
-                # Save the frames as a GIF
-                name = VI_choice + metadata.get('SENSING_TIME', 'N/A')
-                imio.imwrite(f"{name}.gif", frames, duration=1000)
-
+        # One writer per index, opened with the first frame (named after its sensing time)
+        writers = {}
+        # Frames being drawn by the pool, in the order they are written. Capped at a few per worker,
+        #  so a slow writer doesn't let rendered frames pile up in memory.
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_frame_worker, initargs=(cmap,)) if workers > 1 and lut is None else None
+        drawing = deque()
+        try:
+            for collect_ind,collection_name in enumerate(self.order):
+                print('Adding {} to the time series.'.format(collection_name))    
+                try:
+                    with self.granule(collection_name) as image:
+                        available = []
+                        for band_id in bands:
+                            if band_id in image.bands:
+                                available.append(band_id)
+                            else:
+                                # Handle the case where no matching file is found
+                                print(f"File for band {band_id} not found.")
+
+                        # Read each band once from the granule, even if several indices use it
+                        bands_frame = image.read_bands(available, out_shape=image.read_shape(available[0], max_pixels, resolution))
+                        bands_arrays = {band_id: process(bands_frame[np.newaxis,:,:,i], processes) for i, band_id in enumerate(available)}
+                        metadata = image.metadata(available[0])
+
+                    VIarrays = compute_VI(bands_arrays, VI_choices, dtype)
+                except Exception as e:
+                    print(e)
+                    continue
+                del bands_arrays, bands_frame
+                
+                for choice in VI_choices:
+                    if choice not in writers:
+                        name = (choice + metadata.get('SENSING_TIME', 'N/A')).replace('/', '')
+                        writers[choice] = animation_writer(f"{name}.{fmt}", duration=1000)
+                    if lut is not None:
+                        writers[choice].append_data(vi_to_rgb(VIarrays[choice][0], lut))
+                    elif pool is None:
+                        writers[choice].append_data(render_vi_frame(VIarrays[choice][0], metadata, choice, cmap))
+                    else:
+                        drawing.append((choice, pool.submit(render_vi_frame, VIarrays[choice][0], metadata, choice, cmap)))
+                
+                while len(drawing) > 2*workers:
+                    choice, frame = drawing.popleft()
+                    writers[choice].append_data(frame.result())
             
-        # image_files = [file for sublist in self.collects.values() for file in sublist]
-
-        for collect_ind,collection_name in enumerate(self.order):
-            print('Adding {} to the time series.'.format(collection_name))    
-            image_files = list(self.collects[collection_name])                
-            try:
-                bands_arrays = {}
-                for band_id in bands:
-                    try:
-                        # Find the first file in image_files that contains the current band_id
-                        band_file = next(im for im in image_files if band_id in im)
-                        bands_arrays[band_id] = process_image(band_file, processes)
-                    except StopIteration:
-                        # Handle the case where no matching file is found
-                        print(f"File for band {band_id} not found.")
-                        continue
-
-                metadata_collection[collection_name] = get_metadata(band_file)
-
-                VIarray = vi_function(
-                    *[bands_arrays[band] for band in bands]
-                )
-                vegetation_index_arrays.append(VIarray)
-                acutal_order.append(collection_name)
-            except Exception as e:
-                print(e)
-        
-        generate_gif()
+            while drawing:
+                choice, frame = drawing.popleft()
+                writers[choice].append_data(frame.result())
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+            for writer in writers.values():
+                writer.close()
        
     #When called directly, print a summation of the file list.
     def __repr__(self):
@@ -371,9 +665,129 @@ class granules(object):
             raise StopIteration
 
 #An object to handle calling and opening indivudal granules.
+#  Takes the list of files of one collection ID (as stored in granules.collects), and optionally
+#  its {band: file} map (granules.bands). Nothing is read
+#  up front: band files are opened the first time they are used and stay open, and each read
+#  (band, window, output shape) is decoded once and then served from memory. Use close(), or the
+#  object as a context manager, to release the files and the cached arrays.
 class granule(object):
-    def __init__(self,input_list):
-        pass
+    def __init__(self,input_list,bands=None):
+        self.files = list(input_list)
+        names = [parse_name(file) for file in self.files]
+        self.cid = names[0][0] if names and names[0] else None
+        self.bands = bands if bands is not None else {name[4]: file for name, file in zip(names, self.files) if name}
+        self._datasets = {}
+        self._arrays = {}
+    
+    #The file of a band, matched on the band field of the name (HLS.S30.T10SEG.2021001T184729.v2.0.B04.tif).
+    def band_file(self,band):
+        try:
+            return self.bands[band]
+        except KeyError:
+            raise KeyError(f"No {band} file for {self.cid}")
+    
+    #The open rasterio dataset of a band, opened on first use.
+    def open(self,band):
+        if band not in self._datasets:
+            self._datasets[band] = rio.open(self.band_file(band))
+        return self._datasets[band]
+    
+    #Read a band as float with nodata values as NaN (the same array process_image reads).
+    #  window: a rasterio Window (or ((row_start, row_stop), (col_start, col_stop))) to read part of the band.
+    #  out_shape: (rows, cols) to read at. Reads coarser than the band are served from its overviews.
+    #  overview: read at an overview level instead (e.g. 2, 4, 8), in place of out_shape.
+    #  The decoded data is cached, so the returned array is a new copy the caller is free to modify.
+    def read(self,band,window=None,out_shape=None,overview=None,nodata=-9999):
+        array = self.read_raw(band,window,out_shape,overview)
+        return np.where(array==nodata, np.nan, array)
+    
+    #Read several bands into one (rows, cols, bands) float array with nodata values as NaN, the same
+    #  values read returns. Each band is read straight into its slice of out, which can be e.g. a frame
+    #  of a time-series cube, and nodata is replaced in place, so no copies are made. The bands are read
+    #  concurrently on a few threads, since GDAL releases the GIL while decoding. Nothing is cached.
+    #  A missing band raises KeyError before anything is read.
+    def read_bands(self,bands,out=None,window=None,out_shape=None,overview=None,nodata=-9999,dtype=np.float64,workers=4):
+        datasets = [self.open(band) for band in bands]
+        window, out_shape = self._read_shape(datasets[0],window,out_shape,overview)
+        if out_shape is not None:
+            shape = tuple(out_shape)
+        elif window is not None:
+            shape = (int(window.height), int(window.width))
+        else:
+            shape = datasets[0].shape
+        if out is None:
+            out = np.empty(shape + (len(bands),), dtype)
+        elif out.shape != shape + (len(bands),):
+            raise ValueError(f"out has shape {out.shape}, the bands read as {shape + (len(bands),)}")
+        
+        def read_band(bandInd):
+            band = out[:,:,bandInd]
+            datasets[bandInd].read(1, window=window, out=band)
+            np.putmask(band, band==nodata, np.nan)
+        with ThreadPoolExecutor(max_workers=min(workers,len(bands))) as pool:
+            list(pool.map(read_band, range(len(bands))))
+        return out
+    
+    #The output shape to read a band at for a preview: at most max_pixels pixels and/or no finer than
+    #  resolution (in the units of the band's CRS, meters for HLS). Pass it to read/read_bands as
+    #  out_shape; GDAL then reads from the closest overview level of the file (COGs written by
+    #  HLS_PER carry them) instead of the full-resolution raster. None if the band is already small enough.
+    def read_shape(self,band,max_pixels=None,resolution=None):
+        dataset = self.open(band)
+        factor = 1
+        if max_pixels is not None:
+            factor = max(factor, math.sqrt(dataset.height*dataset.width/max_pixels))
+        if resolution is not None:
+            factor = max(factor, resolution/abs(dataset.res[0]))
+        if factor <= 1:
+            return None
+        return (max(1, math.floor(dataset.height/factor)), max(1, math.floor(dataset.width/factor)))
+    
+    #The window and output shape of a read (see read).
+    def _read_shape(self,dataset,window=None,out_shape=None,overview=None):
+        if window is not None and not isinstance(window, rio.windows.Window):
+            window = rio.windows.Window.from_slices(*window)
+        if overview is not None:
+            height, width = (dataset.height, dataset.width) if window is None else (window.height, window.width)
+            out_shape = (math.ceil(height/overview), math.ceil(width/overview))
+        return window, out_shape
+    
+    #The cached data of a band as stored in the file (read-only).
+    def read_raw(self,band,window=None,out_shape=None,overview=None):
+        dataset = self.open(band)
+        window, out_shape = self._read_shape(dataset,window,out_shape,overview)
+        key = (band, None if window is None else tuple(window.flatten()), None if out_shape is None else tuple(out_shape))
+        if key not in self._arrays:
+            shape = None if out_shape is None else (dataset.count,) + tuple(out_shape)
+            array = dataset.read(window=window, out_shape=shape)
+            array.flags.writeable = False
+            self._arrays[key] = array
+        return self._arrays[key]
+    
+    #Metadata of a band file (see get_metadata), from the already open dataset.
+    def metadata(self,band):
+        dataset = self.open(band)
+        metadata = dataset.meta
+        metadata.update(dataset.tags())
+        metadata['crs'] = dataset.crs.to_string()
+        metadata['transform'] = dataset.transform.to_gdal()
+        return metadata
+    
+    #Close every open band file and drop the cached arrays.
+    def close(self):
+        for dataset in self._datasets.values():
+            dataset.close()
+        self._datasets = {}
+        self._arrays = {}
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
+    
+    def __repr__(self):
+        return f"granule({self.cid}, {len(self.files)} files, {len(self._datasets)} open)"
 
 # Usage
 # granule = granules(find())